@@ -0,0 +1 @@
+"""Modeling residential heat pump adoption in the United States."""
@@ -0,0 +1,117 @@
+"""Client for the Power BI report behind the MassSave heat pump dashboard.
+
+https://viewer.dnv.com/macustomerprofile/entity/1444/report/2078
+
+The client is split by what each part needs to import:
+
+- `spec`: the visuals a query can read, Residential Electrification by default (attrs only)
+- `query`: filters and the querydata payload (attrs only)
+- `parse`: decoding DSR responses into frames (polars)
+- `schema`: the compact typed schema of a downloaded table, and Arrow output (polars)
+- `transport`: pooled sessions, retries and rate limiting (requests)
+- `browser`: scraping an EmbedToken from the report (Playwright); `auth` caches it
+- `download`: planning and running downloads (several at once with download_many),
+  checkpoints, Parquet and snapshots
+- `daemon`: a long-running refresh service with a warm browser, driven over a Unix socket
+- `shards`: one download split across workers through a manifest of leased shards
+- `excel`: the dashboard's Excel exports, read into the same table (polars, fastexcel)
+
+Every name below can be imported from the package itself, but its module is only
+imported on first access, so `from hp_adoption.masssave import MassSaveFilter` doesn't
+load Playwright, requests or polars.
+"""
+
+import importlib
+from typing import Any
+
+# Public name -> the submodule that defines it
+_EXPORTS = {
+    "ARROW_SUFFIXES": "schema",
+    "CACHE_DIR": "cache",
+    "CACHE_MODES": "cache",
+    "DEFAULT_FILTER_SETS": "query",
+    "DEFAULT_MAX_CONCURRENCY": "transport",
+    "DEFAULT_MUTABLE_YEARS": "download",
+    "DEFAULT_RESPONSE_CACHE_BYTES": "cache",
+    "DEFAULT_RESPONSE_TTL": "cache",
+    "DEFAULT_SOCKET_PATH": "daemon",
+    "DEFAULT_WINDOW_COUNT": "query",
+    "DNV_REPORT_URL": "browser",
+    "DOWNLOAD_MODES": "download",
+    "FILTERS_TO_SELECTORS": "query",
+    "LEASE_TTL": "shards",
+    "NONESSENTIAL_RESOURCE_TYPES": "browser",
+    "OPERATORS": "query",
+    "PARTITION_DTYPES": "download",
+    "PREREFRESH_LEAD": "daemon",
+    "QUERYDATA_URL": "query",
+    "RESIDENTIAL_ELECTRIFICATION": "spec",
+    "RETRY_STATUSES": "transport",
+    "SECTORS": "spec",
+    "SHARED_HEADERS": "transport",
+    "THROTTLE_STATUSES": "transport",
+    "TOKEN_SAFETY_MARGIN": "auth",
+    "AdaptiveRateLimiter": "transport",
+    "DownloadJob": "download",
+    "MassSaveAuthError": "query",
+    "MassSaveBatch": "query",
+    "MassSaveExcelError": "excel",
+    "MassSaveFilter": "query",
+    "MassSaveQuery": "query",
+    "MassSaveQueryError": "query",
+    "MetricsRecorder": "metrics",
+    "Projection": "spec",
+    "QueryMetrics": "metrics",
+    "RefreshDaemon": "daemon",
+    "ResilientSession": "transport",
+    "ResponseCache": "cache",
+    "RetryPolicy": "transport",
+    "RunCheckpoint": "download",
+    "RunStats": "daemon",
+    "TokenProvider": "auth",
+    "VisualSpec": "spec",
+    "WarmBrowser": "browser",
+    "WorkManifest": "shards",
+    "apply_schema": "schema",
+    "clean_export": "excel",
+    "download_many": "download",
+    "download_many_async": "download",
+    "download_masssave_data": "download",
+    "download_masssave_data_async": "download",
+    "electrification_spec": "spec",
+    "extract_auth_token": "browser",
+    "import_masssave_snapshot": "download",
+    "ingest_masssave_excel": "excel",
+    "json_to_df": "parse",
+    "json_to_total": "parse",
+    "make_session": "transport",
+    "masssave_schema": "schema",
+    "merge_shards": "shards",
+    "parse_export_name": "excel",
+    "payload_key": "query",
+    "refresh_masssave_snapshot": "download",
+    "run_worker": "shards",
+    "run_worker_async": "shards",
+    "send_command": "daemon",
+    "to_arrow": "schema",
+    "scan_masssave": "download",
+    "token_expiry": "auth",
+    "write_ipc_stream": "schema",
+    "write_outfile": "download",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")  # noqa: TRY003
+    value = getattr(importlib.import_module(f"{__name__}.{module}"), name)
+    # Later lookups find it without coming back here
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_EXPORTS])
@@ -0,0 +1,30 @@
+"""Download the full table to masssave_hpinstalls_<date>.csv: `python -m hp_adoption.masssave`."""
+
+import argparse
+from datetime import datetime
+
+from hp_adoption.masssave.download import DOWNLOAD_MODES, download_masssave_data
+from hp_adoption.masssave.query import DEFAULT_WINDOW_COUNT
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=DOWNLOAD_MODES, default="combos")
+    parser.add_argument(
+        "--window-count",
+        type=int,
+        default=DEFAULT_WINDOW_COUNT,
+        help=f"rows per response page; cube mode does better with more (default: {DEFAULT_WINDOW_COUNT})",
+    )
+    args = parser.parse_args(argv)
+
+    date = datetime.now().strftime("%Y%m%d")
+    outfile = f"masssave_hpinstalls_{date}.csv"
+    download_masssave_data(outfile=outfile, mode=args.mode, window_count=args.window_count)
+
+
+if __name__ == "__main__":
+    main()
+
+# TODO: This didn't *quite* line up with website (see, Yarmouth 2019). Rows that use DSR repeat compression
+# used to be dropped, which would explain it; re-check against the website now that they are decoded.
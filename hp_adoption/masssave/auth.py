@@ -0,0 +1,96 @@
+"""EmbedTokens: reading their expiry and handing out a cached one until it runs out.
+
+Nothing here starts a browser until a new token is actually needed (see browser.py).
+"""
+
+import base64
+import json
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from attrs import define, field
+
+from hp_adoption.masssave.cache import CACHE_DIR
+
+if TYPE_CHECKING:
+    from hp_adoption.masssave.browser import WarmBrowser
+
+# Don't hand out a cached token with less than this many seconds left on it
+TOKEN_SAFETY_MARGIN = 300
+
+
+def token_expiry(token: str) -> float:
+    """Return the `exp` claim (unix seconds) from an EmbedToken.
+
+    The token is `<compressed body>.<base64 JSON payload>`, and the payload carries
+    the cluster URL and expiry in the clear.
+    """
+    payload = token.rsplit(".", 1)[-1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    return float(claims["exp"])
+
+
+@define()
+class TokenProvider:
+    """Hand out an EmbedToken, scraping a new one with Playwright only when the cached one won't do.
+
+    The last scraped token is kept in `path` and reused for as long as it has more than
+    `safety_margin` seconds left before its own `exp` claim. With a `warm_browser`, new
+    tokens are scraped in it rather than in a freshly launched Chromium.
+    """
+
+    path: Path = field(default=CACHE_DIR / "masssave_token.json", converter=Path)
+    safety_margin: float = field(default=TOKEN_SAFETY_MARGIN)
+    # Passed through to extract_auth_token (timeout, block_resources, ...)
+    scrape_options: dict[str, Any] = field(factory=dict)
+    warm_browser: "WarmBrowser | None" = field(default=None)
+    _token: str | None = field(default=None, init=False)
+
+    def expires_in(self, token: str) -> float:
+        """Seconds until `token` stops being handed out (its `exp` less the safety margin)."""
+        return token_expiry(token) - time.time() - self.safety_margin
+
+    def is_fresh(self, token: str) -> bool:
+        try:
+            return self.expires_in(token) > 0
+        except (ValueError, KeyError):
+            return False
+
+    def _load(self) -> str | None:
+        try:
+            token: str = json.loads(self.path.read_text())["token"]
+        except (OSError, ValueError, KeyError):
+            return None
+        return token
+
+    def _store(self, token: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"token": token, "exp": token_expiry(token)}))
+        tmp.chmod(0o600)
+        tmp.replace(self.path)
+
+    async def get_token(self) -> str:
+        token = self._token or self._load()
+        if token is not None and self.is_fresh(token):
+            self._token = token
+            return token
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        if self.warm_browser is not None:
+            token = await self.warm_browser.extract_auth_token(**self.scrape_options)
+        else:
+            # Only now is Playwright imported
+            from hp_adoption.masssave import browser
+
+            token = await browser.extract_auth_token(**self.scrape_options)
+        self._token = token
+        self._store(token)
+        return token
+
+    def invalidate(self) -> None:
+        """Forget the current token, e.g. because the service rejected it."""
+        self._token = None
+        self.path.unlink(missing_ok=True)
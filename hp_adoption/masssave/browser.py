@@ -0,0 +1,144 @@
+"""Scraping an EmbedToken out of the public report with a headless browser (Playwright).
+
+extract_auth_token starts a browser per token; a WarmBrowser keeps one running between tokens.
+"""
+
+import asyncio
+from typing import Any
+
+from attrs import define, field
+from playwright.async_api import async_playwright
+
+DNV_REPORT_URL = "https://viewer.dnv.com/macustomerprofile/entity/1444/report/2078"
+
+# The token only needs the report's scripts and XHRs, not what it renders
+NONESSENTIAL_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+
+
+async def _capture_token(page: Any, timeout: float, block_resources: bool, report_url: str) -> str:
+    """Load the report in `page` and return the EmbedToken of its first querydata request."""
+    # Resolved with the authorization header of the first queryData request
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    token_future: asyncio.Future[str] = loop.create_future()
+
+    # Listen for network requests to capture the token
+    def handle_request(request: Any) -> None:
+        if "querydata" not in request.url.lower() or token_future.done():
+            return
+        # print(f"Found queryData request: {request.url}")
+        headers = request.headers
+        if "authorization" in headers:
+            print(f"Found authorization token: {headers['authorization'][:50]}...")
+            token_future.set_result(headers["authorization"])
+        else:
+            token_future.set_exception(
+                ValueError(
+                    f"No authorization header found in queryData request\nAvailable headers: {list(headers.keys())}"
+                )
+            )
+
+    async def handle_route(route: Any) -> None:
+        request = route.request
+        if request.resource_type in NONESSENTIAL_RESOURCE_TYPES or (
+            token_future.done() and "querydata" in request.url.lower()
+        ):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    page.on("request", handle_request)
+    if block_resources:
+        await page.route("**/*", handle_route)
+
+    try:
+        # Navigate to the page; the token usually arrives shortly after DOMContentLoaded
+        print("Navigating to the page...")
+        try:
+            await page.goto(report_url, wait_until="domcontentloaded", timeout=timeout * 1000)
+        except Exception as e:
+            raise ValueError("Page load timeout") from e  # noqa: TRY003
+
+        # Wait for the queryData request to be made, but no longer than the overall timeout
+        try:
+            auth_token = await asyncio.wait_for(token_future, max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError as e:
+            raise ValueError("Could not find authorization token in queryData requests") from e  # noqa: TRY003
+
+        print(f"Successfully extracted authorization token: {auth_token}")
+        assert "EmbedToken" in auth_token, "Authorization token does not start with EmbedToken"  # noqa: S101
+        return auth_token.removeprefix("EmbedToken ")
+
+    except Exception as e:
+        raise ValueError("Error") from e
+
+
+async def extract_auth_token(
+    timeout: float = 30.0,
+    block_resources: bool = True,
+    report_url: str = DNV_REPORT_URL,
+    executable_path: str | None = "/usr/bin/chromium",
+) -> str:
+    """
+    h/t Claude
+
+    Returns as soon as the report's first querydata request shows up, or raises once
+    `timeout` seconds have passed without one. With `block_resources`, images, fonts and
+    media are never fetched and the report's own queries are dropped once we have the token.
+    """
+    async with async_playwright() as p:
+        # Launch browser using system Chromium
+        browser = await p.chromium.launch(
+            executable_path=executable_path,
+            headless=True,
+        )
+        page = await browser.new_page()
+        try:
+            return await _capture_token(page, timeout, block_resources, report_url)
+        finally:
+            await browser.close()
+
+
+@define()
+class WarmBrowser:
+    """A Chromium that stays up between scrapes, for processes that need a token again and again.
+
+    extract_auth_token launches and closes a browser for every token; here only the
+    first scrape pays for the launch, and later ones open a page in the same context
+    (with its cookies and storage). A browser that has died is relaunched on the next scrape.
+    """
+
+    executable_path: str | None = "/usr/bin/chromium"
+    _playwright: Any = field(default=None, init=False)
+    _browser: Any = field(default=None, init=False)
+    _context: Any = field(default=None, init=False)
+
+    @property
+    def running(self) -> bool:
+        return self._browser is not None and self._browser.is_connected()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        await self.close()
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(executable_path=self.executable_path, headless=True)
+        self._context = await self._browser.new_context()
+
+    async def close(self) -> None:
+        if self._browser is not None and self._browser.is_connected():
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._playwright = self._browser = self._context = None
+
+    async def extract_auth_token(
+        self, timeout: float = 30.0, block_resources: bool = True, report_url: str = DNV_REPORT_URL
+    ) -> str:
+        """Like the module's extract_auth_token, in a new page of the running browser."""
+        await self.start()
+        page = await self._context.new_page()
+        try:
+            return await _capture_token(page, timeout, block_resources, report_url)
+        finally:
+            await page.close()
@@ -0,0 +1,98 @@
+"""On-disk cache of querydata responses."""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from attrs import define, field
+
+# Local state (tokens, responses) lives here between runs
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "hp-adoption"
+
+# Cached querydata responses expire after this many seconds and are evicted, least
+# recently used first, once the cache grows past this many bytes
+DEFAULT_RESPONSE_TTL = 30 * 24 * 3600
+DEFAULT_RESPONSE_CACHE_BYTES = 512 * 1024**2
+# Eviction goes down to this share of `max_bytes`, so the next ones are many puts away
+EVICT_TO = 0.9
+CACHE_MODES = ["use", "refresh", "bypass"]
+
+
+@define()
+class ResponseCache:
+    """On-disk store of raw querydata responses, keyed on `payload_key` of the query and its endpoint.
+
+    The EmbedToken only travels in the headers, so a cached response stays valid
+    across tokens. Entries older than `ttl` seconds are ignored, and once the cache
+    holds more than `max_bytes` the least recently read entries are dropped.
+
+    The cache's size is scanned from disk once, at the first put, and kept up to date
+    from there; only a put that takes it past `max_bytes` scans again to evict.
+    """
+
+    path: Path = field(default=CACHE_DIR / "responses", converter=Path)
+    ttl: float | None = field(default=DEFAULT_RESPONSE_TTL)
+    max_bytes: int = field(default=DEFAULT_RESPONSE_CACHE_BYTES)
+    _size: int | None = field(default=None, init=False)
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> bytes | None:
+        file = self._file(key)
+        try:
+            stat = file.stat()
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                file.unlink(missing_ok=True)
+                return None
+            content = file.read_bytes()
+        except FileNotFoundError:
+            return None
+        # Bump the access time (but not the write time the TTL runs from) for LRU eviction
+        os.utime(file, (time.time(), stat.st_mtime))
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=file.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        try:
+            replaced = file.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, file)
+
+        if self._size is None:
+            self._size = sum(stat.st_size for _, stat in self._entries())
+        else:
+            # Other processes may write to the same cache; the next scan catches up with them
+            self._size += len(content) - replaced
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        entries = []
+        for file in self.path.glob("*/*.json"):
+            try:
+                entries.append((file, file.stat()))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _evict(self) -> None:
+        entries = self._entries()
+        total = sum(stat.st_size for _, stat in entries)
+        for file, stat in sorted(entries, key=lambda e: e[1].st_atime):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            file.unlink(missing_ok=True)
+            total -= stat.st_size
+        self._size = total
+
+    def clear(self) -> None:
+        for file in self.path.glob("*/*.json"):
+            file.unlink(missing_ok=True)
+        self._size = 0
@@ -0,0 +1,299 @@
+"""A long-running refresh service: one warm browser and token, downloads on request.
+
+Every `python -m hp_adoption.masssave` starts Python, Playwright and Chromium and scrapes
+a token before sending a single query. The daemon pays for that once: it keeps a
+WarmBrowser up, scrapes a new token `prerefresh_lead` seconds before the current one
+would go stale, and runs the refresh jobs it is sent over a Unix socket with that
+token, so a refresh costs only its queries.
+
+    python -m hp_adoption.masssave.daemon serve &
+    python -m hp_adoption.masssave.daemon refresh --wait '{"outfile": "masssave.csv", "mode": "cube"}'
+    python -m hp_adoption.masssave.daemon health
+
+The protocol is one JSON object per line each way. Requests carry a "command":
+
+- "refresh": run `jobs` (name -> DownloadJob fields, plus an optional "sector" for
+  electrification_spec) together with download_many. Jobs are run one refresh at a
+  time in the order they arrive; with "wait" the reply comes once the run is done.
+- "health": token, queue and last run at a glance.
+- "stats": the recent runs (RunStats), newest last.
+- "stop": shut down, cancelling any refresh still running (one with a run_dir
+  can be resumed).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import socket
+import sys
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from attrs import asdict, define, field
+
+from hp_adoption.masssave.auth import TokenProvider
+from hp_adoption.masssave.cache import CACHE_DIR, CACHE_MODES
+from hp_adoption.masssave.download import DownloadJob, download_many_async, job_from_dict
+from hp_adoption.masssave.metrics import MetricsRecorder
+
+DEFAULT_SOCKET_PATH = CACHE_DIR / "masssave.sock"
+
+# Scrape a new token this many seconds before the provider would stop handing out the
+# current one, so a refresh never waits on the browser
+PREREFRESH_LEAD = 600
+
+# After a failed scrape, try again this many seconds later
+TOKEN_RETRY_DELAY = 60
+
+# How many finished runs "stats" reports
+RUN_HISTORY = 50
+
+# The DownloadJob fields that name files or directories
+JOB_PATHS = ["outfile", "run_dir", "parquet_dir"]
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+@define()
+class RunStats:
+    """What one refresh did: when it ran, how many rows each job got and how many pages it took."""
+
+    jobs: list[str]
+    queued: str = field(factory=_now)
+    started: str | None = None
+    finished: str | None = None
+    seconds: float | None = None
+    rows: dict[str, int] = field(factory=dict)
+    pages: int = 0
+    cached_pages: int = 0
+    error: str | None = None
+
+
+@define()
+class _Request:
+    jobs: dict[str, DownloadJob]
+    stats: RunStats
+    done: asyncio.Future
+
+
+def _warm_token_provider() -> TokenProvider:
+    # Only now is Playwright imported
+    from hp_adoption.masssave.browser import WarmBrowser
+
+    return TokenProvider(warm_browser=WarmBrowser())
+
+
+@define()
+class RefreshDaemon:
+    """Serve refresh jobs on `socket_path`, keeping the token of `token_provider` fresh in the background.
+
+    The default provider scrapes in a WarmBrowser. `download_options` go to every
+    download_many call (max_concurrency, cache, cache_mode, retry, endpoint_url, ...),
+    which all share the daemon's token. A refresh is there to pick up new data, so
+    jobs go past the response cache (cache_mode="refresh") unless the options say otherwise.
+    """
+
+    socket_path: Path = field(default=DEFAULT_SOCKET_PATH, converter=Path)
+    token_provider: TokenProvider = field(factory=_warm_token_provider)
+    prerefresh_lead: float = PREREFRESH_LEAD
+    download_options: dict[str, Any] = field(factory=dict)
+    runs: deque[RunStats] = field(init=False, factory=lambda: deque(maxlen=RUN_HISTORY))
+    _token: str | None = field(default=None, init=False)
+    _token_error: str | None = field(default=None, init=False)
+    _token_refreshes: int = field(default=0, init=False)
+    _running: RunStats | None = field(default=None, init=False)
+    _started: float = field(default=0.0, init=False)
+    _queue: asyncio.Queue = field(init=False, factory=asyncio.Queue)
+    _stopping: asyncio.Event = field(init=False, factory=asyncio.Event)
+
+    def __attrs_post_init__(self) -> None:
+        cache_mode = self.download_options.get("cache_mode")
+        if cache_mode is not None and cache_mode not in CACHE_MODES:
+            raise ValueError(f"Invalid cache_mode: {cache_mode}")  # noqa: TRY003
+
+    async def serve(self) -> None:
+        """Run until a "stop" command arrives."""
+        self._claim_socket()
+        self._started = time.time()
+
+        server = await asyncio.start_unix_server(self._handle, path=str(self.socket_path))
+        tasks = [asyncio.create_task(self._keep_token_fresh()), asyncio.create_task(self._work())]
+        try:
+            async with server:
+                await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.token_provider.warm_browser is not None:
+                await self.token_provider.warm_browser.close()
+            self.socket_path.unlink(missing_ok=True)
+
+    def _claim_socket(self) -> None:
+        """Take over `socket_path`, unless another daemon is still answering on it."""
+        if not self.socket_path.exists():
+            self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+            return
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(str(self.socket_path))
+            except OSError:
+                # Left behind by a daemon that didn't shut down cleanly
+                self.socket_path.unlink()
+                return
+        raise FileExistsError(f"A daemon is already listening on {self.socket_path}")  # noqa: TRY003
+
+    async def _keep_token_fresh(self) -> None:
+        """Hold a token at all times, scraping the next one `prerefresh_lead` seconds before it goes stale."""
+        refresh = False
+        while True:
+            try:
+                provider = self.token_provider
+                self._token = await (provider.refresh() if refresh else provider.get_token())
+                self._token_error = None
+                self._token_refreshes += refresh
+                refresh = True
+                delay = max(provider.expires_in(self._token) - self.prerefresh_lead, 1.0)
+            except Exception as e:
+                # The daemon outlives a failed scrape; a run in the meantime scrapes for itself
+                self._token_error = f"{type(e).__name__}: {e}"
+                delay = TOKEN_RETRY_DELAY
+            await asyncio.sleep(delay)
+
+    async def _work(self) -> None:
+        while True:
+            request = await self._queue.get()
+            await self._run(request)
+
+    async def _run(self, request: _Request) -> None:
+        stats = self._running = request.stats
+        stats.started = _now()
+        started = time.perf_counter()
+        recorder = MetricsRecorder()
+        options = {"cache_mode": "refresh", **self.download_options, "report": False}
+        options["hooks"] = [*options.get("hooks", []), recorder]
+        try:
+            # The provider hands out the token kept fresh by _keep_token_fresh
+            tables = await download_many_async(request.jobs, token_provider=self.token_provider, **options)
+            stats.rows = {name: table.height for name, table in tables.items()}
+        except Exception as e:
+            # Reported in the run's stats, and the next run goes ahead
+            stats.error = f"{type(e).__name__}: {e}"
+        stats.finished = _now()
+        stats.seconds = round(time.perf_counter() - started, 3)
+        stats.pages = len(recorder.records)
+        stats.cached_pages = sum(m.cached for m in recorder.records)
+        self.runs.append(stats)
+        self._running = None
+        if not request.done.done():
+            request.done.set_result(stats)
+
+    def health(self) -> dict[str, Any]:
+        try:
+            expires_in = round(self.token_provider.expires_in(self._token), 1) if self._token else None
+        except (ValueError, KeyError):
+            expires_in = None
+        return {
+            "status": "ok" if self._token_error is None else "degraded",
+            "uptime_s": round(time.time() - self._started, 1),
+            "token_expires_in_s": expires_in,
+            "token_refreshes": self._token_refreshes,
+            "token_error": self._token_error,
+            "browser_running": self.token_provider.warm_browser is not None
+            and self.token_provider.warm_browser.running,
+            "queued": self._queue.qsize(),
+            "running": asdict(self._running) if self._running else None,
+            "last_run": asdict(self.runs[-1]) if self.runs else None,
+            "failed_runs": sum(run.error is not None for run in self.runs),
+        }
+
+    async def _respond(self, message: dict[str, Any]) -> dict[str, Any]:
+        command = message.get("command")
+        if command == "health":
+            return {"ok": True, **self.health()}
+        if command == "stats":
+            return {"ok": True, "runs": [asdict(run) for run in self.runs]}
+        if command == "stop":
+            self._stopping.set()
+            return {"ok": True}
+        if command != "refresh":
+            raise ValueError(f"Unknown command: {command}")  # noqa: TRY003
+
+        jobs = {name: job_from_dict(fields) for name, fields in message.get("jobs", {"masssave": {}}).items()}
+        request = _Request(jobs, RunStats(list(jobs)), asyncio.get_running_loop().create_future())
+        self._queue.put_nowait(request)
+        if not message.get("wait"):
+            return {"ok": True, "queued": list(jobs), "position": self._queue.qsize()}
+        stats = await request.done
+        return {"ok": stats.error is None, **asdict(stats)}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = await self._respond(json.loads(line))
+                except (ValueError, TypeError) as e:
+                    reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+
+def send_command(
+    message: dict[str, Any], socket_path: str | Path = DEFAULT_SOCKET_PATH, timeout: float | None = None
+) -> dict[str, Any]:
+    """Send one request to a running daemon and return its reply."""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            reply: dict[str, Any] = json.loads(f.readline())
+    return reply
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", type=Path, default=DEFAULT_SOCKET_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the daemon in the foreground")
+    serve.add_argument("--max-concurrency", type=int)
+    serve.add_argument("--cache-mode", choices=CACHE_MODES, help="how jobs use the response cache (default: refresh)")
+    refresh = commands.add_parser("refresh", help="queue a download (the full table by default)")
+    refresh.add_argument("job", nargs="?", help="DownloadJob fields as JSON")
+    refresh.add_argument("--name", default="masssave")
+    refresh.add_argument("--wait", action="store_true", help="reply once the download is done")
+    for command in ("health", "stats", "stop"):
+        commands.add_parser(command)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        options = {"max_concurrency": args.max_concurrency, "cache_mode": args.cache_mode}
+        daemon = RefreshDaemon(args.socket, download_options={k: v for k, v in options.items() if v is not None})
+        asyncio.run(daemon.serve())
+        return
+    message: dict[str, Any] = {"command": args.command}
+    if args.command == "refresh":
+        job = json.loads(args.job) if args.job else {"outfile": f"masssave_hpinstalls_{datetime.now():%Y%m%d}.csv"}
+        # The daemon has its own working directory, so paths are resolved here
+        for key in JOB_PATHS:
+            if job.get(key) is not None:
+                job[key] = str(Path(job[key]).expanduser().absolute())
+        message |= {"jobs": {args.name: job}, "wait": args.wait}
+    reply = send_command(message, args.socket)
+    print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,773 @@
+"""Downloading the whole table: planning the queries, running them concurrently, and storing the results.
+
+Results can be checkpointed per combination, written to a Hive-partitioned Parquet
+dataset, or kept as dated snapshots (see hp_adoption.snapshots).
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+from urllib.parse import quote
+
+import polars as pl
+import requests
+from attrs import define, field
+
+from hp_adoption.masssave.auth import TokenProvider
+from hp_adoption.masssave.cache import CACHE_MODES, ResponseCache
+from hp_adoption.masssave.metrics import MetricsRecorder, QueryMetrics
+from hp_adoption.masssave.query import (
+    DEFAULT_FILTER_SETS,
+    DEFAULT_WINDOW_COUNT,
+    QUERYDATA_URL,
+    MassSaveAuthError,
+    MassSaveBatch,
+    MassSaveFilter,
+    MassSaveQuery,
+    MassSaveQueryError,
+    _combo_key,
+    _filter_col,
+)
+from hp_adoption.masssave.schema import ARROW_SUFFIXES, apply_schema, write_ipc_stream
+from hp_adoption.masssave.spec import RESIDENTIAL_ELECTRIFICATION, VisualSpec, electrification_spec
+from hp_adoption.masssave.transport import DEFAULT_MAX_CONCURRENCY, AdaptiveRateLimiter, RetryPolicy, make_session
+from hp_adoption.snapshots import SnapshotStore
+
+# "combos" sends one query per point of the filter product; "cube" projects the filter
+# dimensions as grouping columns and sends one query per value of the split dimensions
+DOWNLOAD_MODES = ["combos", "cube"]
+
+# Partition columns of the Parquet output that aren't text
+PARTITION_DTYPES = {"year": pl.Int16}
+
+
+# Program years whose numbers can still change on a refresh: the current and the previous one
+DEFAULT_MUTABLE_YEARS = 2
+
+
+def _filter_combos(filter_sets: dict[str, list[str]]) -> list[tuple[MassSaveFilter, ...]]:
+    query_filters = []
+    for col, vals in filter_sets.items():
+        query_filters.append([MassSaveFilter(column=col, values=[val], operator="In") for val in vals])
+    return list(itertools.product(*query_filters))
+
+
+def _plan_queries(
+    filter_sets: dict[str, list[str]], mode: str, cube_split_by: list[str]
+) -> list[tuple[tuple[MassSaveFilter, ...], list[str]]]:
+    """The (filters, group_by) of each query needed to cover the product of `filter_sets`."""
+    if mode == "combos":
+        return [(filter_combos, []) for filter_combos in _filter_combos(filter_sets)]
+    split_sets = {col: vals for col, vals in filter_sets.items() if col in cube_split_by}
+    group_by = [col for col in filter_sets if col not in cube_split_by]
+    grouped = tuple(MassSaveFilter(column=col, values=filter_sets[col], operator="In") for col in group_by)
+    return [(filter_combos + grouped, group_by) for filter_combos in _filter_combos(split_sets)]
+
+
+def _probe_query(filter_sets: dict[str, list[str]], **options: Any) -> MassSaveQuery:
+    """One coarse query over every filter dimension but not the city: its rows are the non-empty combinations."""
+    ((filters, group_by),) = _plan_queries(filter_sets, "cube", cube_split_by=[])
+    return MassSaveQuery(filters=list(filters), group_by=group_by, by_municipality=False, **options)
+
+
+def _prune_plan(
+    plan: list[tuple[tuple[MassSaveFilter, ...], list[str]]], probe: pl.DataFrame
+) -> tuple[list[tuple[tuple[MassSaveFilter, ...], list[str]]], list[tuple[tuple[MassSaveFilter, ...], list[str]]]]:
+    """Split `plan` into the queries that cover a combination `probe` found, and those that can't return rows."""
+    nonempty = probe.drop("installed_hp_accounts", "installed_hp_locations").to_dicts()
+    keep: list[tuple[tuple[MassSaveFilter, ...], list[str]]] = []
+    pruned: list[tuple[tuple[MassSaveFilter, ...], list[str]]] = []
+    for entry in plan:
+        wanted = [(_filter_col(f.column), set(f.values)) for f in entry[0]]
+        hit = any(all(row[col] in values for col, values in wanted) for row in nonempty)
+        (keep if hit else pruned).append(entry)
+    return keep, pruned
+
+
+def _tag_combo(
+    df: pl.DataFrame, filter_combos: tuple[MassSaveFilter, ...], group_by: list[str] | None = None
+) -> pl.DataFrame:
+    # Grouped dimensions already came back as columns
+    return df.with_columns(*[
+        pl.lit(f.values[0]).alias(_filter_col(f.column)) for f in filter_combos if f.column not in (group_by or [])
+    ])
+
+
+def _empty_result(filter_cols: list[str], spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION) -> pl.DataFrame:
+    """The table of a download in which no combination had any installs, with the columns a full one has."""
+    return pl.DataFrame(
+        schema={
+            **dict.fromkeys(filter_cols, pl.String),
+            **{row.column: pl.String for row in spec.rows},
+            **{measure.column: pl.Int64 for measure in spec.measures},
+        }
+    )
+
+
+def _combine(
+    dfs: list[pl.DataFrame], filter_cols: list[str], spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION
+) -> pl.DataFrame:
+    if not dfs:
+        # Nothing had any installs (common for a shard of a sparse product)
+        return _empty_result(filter_cols, spec)
+    return pl.concat(dfs).sort(filter_cols).select(*[pl.col(s) for s in filter_cols], pl.all().exclude(filter_cols))
+
+
+def _fsync(path: Path) -> None:
+    with path.open("rb") as f:
+        os.fsync(f.fileno())
+
+
+@define()
+class RunCheckpoint:
+    """Durable record of a download run, so an interrupted run can pick up where it stopped.
+
+    Each finished combination's rows go to `path/combos/`, and its outcome (done, empty
+    or failed) is appended to `path/manifest.jsonl` and fsync'ed before the run moves
+    on. Replaying the manifest tells a resumed run which combinations are still outstanding.
+    """
+
+    path: Path = field(converter=Path)
+    statuses: dict[str, str] = field(factory=dict, init=False)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.path / "manifest.jsonl"
+
+    def exists(self) -> bool:
+        return self.manifest_path.exists()
+
+    def load(self) -> None:
+        self.statuses = {}
+        for line in self.manifest_path.read_text().splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn last line from a crash mid-write
+            self.statuses[entry["combo"]] = entry["status"]
+
+    def status(self, filter_combos: tuple[MassSaveFilter, ...]) -> str | None:
+        return self.statuses.get(_combo_key(filter_combos))
+
+    def _combo_file(self, key: str) -> Path:
+        return self.path / "combos" / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.parquet"
+
+    def record(
+        self, filter_combos: tuple[MassSaveFilter, ...], df: pl.DataFrame | None, error: Exception | None = None
+    ) -> None:
+        key = _combo_key(filter_combos)
+        entry = {"combo": key, "time": datetime.now().isoformat(timespec="seconds")}
+        if error is not None:
+            entry |= {"status": "failed", "error": f"{type(error).__name__}: {error}"}
+        elif df is None or df.is_empty():
+            entry["status"] = "empty"
+        else:
+            # Rows hit the disk before the manifest says they are there
+            file = self._combo_file(key)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_suffix(".tmp")
+            df.write_parquet(tmp)
+            _fsync(tmp)
+            os.replace(tmp, file)
+            entry["status"] = "done"
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self.manifest_path.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.statuses[key] = entry["status"]
+
+    def read(self, filter_combos: tuple[MassSaveFilter, ...]) -> pl.DataFrame:
+        return pl.read_parquet(self._combo_file(_combo_key(filter_combos)))
+
+
+def _open_checkpoint(run_dir: str | Path | None, resume: bool) -> RunCheckpoint | None:
+    if run_dir is None:
+        if resume:
+            raise ValueError("resume=True needs a run_dir")  # noqa: TRY003
+        return None
+    checkpoint = RunCheckpoint(run_dir)
+    if checkpoint.exists():
+        if not resume:
+            raise FileExistsError(f"{run_dir} already holds a run; pass resume=True to continue it")  # noqa: TRY003
+        checkpoint.load()
+    return checkpoint
+
+
+def _raise_on_failures(combos: list[tuple[MassSaveFilter, ...]], checkpoint: RunCheckpoint | None) -> None:
+    if checkpoint is None:
+        return
+    failed = [c for c in combos if checkpoint.status(c) == "failed"]
+    if failed:
+        raise MassSaveQueryError(  # noqa: TRY003
+            f"{len(failed)} of {len(combos)} combinations failed; rerun with resume=True to retry them"
+        )
+
+
+def _partition_dir(root: str | Path, partition_cols: list[str], key: tuple) -> Path:
+    return Path(root).joinpath(*(f"{c}={quote(str(v), safe='')}" for c, v in zip(partition_cols, key)))
+
+
+def _write_partitions(df: pl.DataFrame, root: str | Path, partition_cols: list[str]) -> set[Path]:
+    """Write `df` into the Hive-partitioned dataset at `root`, one file per leaf partition.
+
+    Rewriting a partition replaces its file, so re-running a combination is idempotent.
+    Returns the leaf directories written.
+    """
+    df = df.with_columns(pl.col(c).cast(PARTITION_DTYPES.get(c, pl.String)) for c in partition_cols)
+    written = set()
+    for key, part in df.partition_by(partition_cols, as_dict=True, include_key=False).items():
+        directory = _partition_dir(root, partition_cols, key)
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = directory / "data.parquet.tmp"
+        part.write_parquet(tmp)
+        os.replace(tmp, directory / "data.parquet")
+        written.add(directory)
+    return written
+
+
+def _covered_partitions(
+    root: str | Path, partition_cols: list[str], filter_combos: tuple[MassSaveFilter, ...]
+) -> set[Path]:
+    """The leaf directories of every combination a query over `filter_combos` answers for."""
+    values = {_filter_col(f.column): f.values for f in filter_combos}
+    cast = [pl.Series(values[c]).cast(PARTITION_DTYPES.get(c, pl.String)).to_list() for c in partition_cols]
+    return {_partition_dir(root, partition_cols, key) for key in itertools.product(*cast)}
+
+
+def scan_masssave(root: str | Path) -> pl.LazyFrame:
+    """Lazily scan a dataset written by `download_masssave_data(parquet_dir=...)`.
+
+    Filters on the partition columns (year, end_use, ...) skip whole directories, and
+    other predicates are pushed down into the Parquet reader. A download in which no
+    combination had any installs writes no files, and scanning it raises FileNotFoundError.
+    """
+    root = Path(root)
+    first = next(root.rglob("data.parquet"), None)
+    if first is None:
+        raise FileNotFoundError(f"No MassSave Parquet dataset under {root}")  # noqa: TRY003
+    keys = [part.split("=", 1)[0] for part in first.relative_to(root).parts[:-1]]
+    schema = {key: PARTITION_DTYPES.get(key, pl.String) for key in keys}
+    lf = pl.scan_parquet(root, hive_partitioning=True, hive_schema=schema)
+    return lf.select(*keys, pl.all().exclude(keys))
+
+
+def _read_partitions(
+    root: str | Path, filter_sets: dict[str, list[str]], spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION
+) -> pl.DataFrame:
+    """Read back the requested part of a Parquet dataset, shaped like the in-memory result."""
+    filter_cols = [_filter_col(s) for s in filter_sets]
+    if next(Path(root).rglob("data.parquet"), None) is None:
+        return _empty_result(filter_cols, spec)
+    lf = scan_masssave(root)
+    for col, vals in filter_sets.items():
+        dtype = PARTITION_DTYPES.get(_filter_col(col), pl.String)
+        lf = lf.filter(pl.col(_filter_col(col)).is_in(pl.Series(vals).cast(dtype).to_list()))
+    return lf.with_columns(pl.col(c).cast(pl.String) for c in filter_cols).sort(filter_cols).collect()
+
+
+def _collect(
+    combos: list[tuple[MassSaveFilter, ...]],
+    results: dict[str, pl.DataFrame | None],
+    checkpoint: RunCheckpoint | None,
+) -> list[pl.DataFrame]:
+    """Gather the non-empty frames for `combos`, in order, from this run's results or the checkpoint."""
+    dfs = []
+    for filter_combos in combos:
+        key = _combo_key(filter_combos)
+        if key in results:
+            df = results[key]
+        elif checkpoint is not None and checkpoint.status(filter_combos) == "done":
+            df = checkpoint.read(filter_combos)
+        else:
+            df = None
+        if df is None or df.is_empty():
+            print(f"No data found for filters: {filter_combos}")
+            continue
+        dfs.append(df)
+    return dfs
+
+
+@define()
+class _ResultSink:
+    """Where finished queries go: the run checkpoint, the Parquet dataset, and/or memory."""
+
+    filter_cols: list[str]
+    checkpoint: RunCheckpoint | None = None
+    parquet_dir: str | Path | None = None
+    spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION
+
+    def failed(self, filter_combos: tuple[MassSaveFilter, ...], error: Exception) -> None:
+        print(f"Query failed for filters: {filter_combos}: {error}")
+        if self.checkpoint is not None:
+            self.checkpoint.record(filter_combos, None, error=error)
+
+    def done(self, filter_combos: tuple[MassSaveFilter, ...], df: pl.DataFrame) -> pl.DataFrame | None:
+        """Record a finished query; returns the frame only if it should be kept in memory."""
+        if self.checkpoint is not None:
+            self.checkpoint.record(filter_combos, df)
+        if self.parquet_dir is None:
+            return df
+        written: set[Path] = set()
+        if df.is_empty():
+            print(f"No data found for filters: {filter_combos}")
+        else:
+            written = _write_partitions(df, self.parquet_dir, self.filter_cols)
+        # Combinations that came back empty drop whatever an earlier run into the directory left there
+        for directory in _covered_partitions(self.parquet_dir, self.filter_cols, filter_combos) - written:
+            (directory / "data.parquet").unlink(missing_ok=True)
+        return None
+
+    def assemble(
+        self,
+        filter_sets: dict[str, list[str]],
+        combos: list[tuple[MassSaveFilter, ...]],
+        results: dict[str, pl.DataFrame | None],
+    ) -> pl.DataFrame:
+        _raise_on_failures(combos, self.checkpoint)
+        if self.parquet_dir is not None:
+            return _read_partitions(self.parquet_dir, filter_sets, self.spec)
+        return _combine(_collect(combos, results, self.checkpoint), self.filter_cols, self.spec)
+
+
+@define()
+class _QueryRunner:
+    """Runs queries over one shared session and token, with at most `max_concurrency` in flight."""
+
+    session: requests.Session
+    token_provider: TokenProvider
+    auth_token: str | None
+    max_concurrency: int
+    cache: ResponseCache | None = None
+    refresh: bool = False
+    _semaphore: asyncio.Semaphore = field(init=False)
+    _refresh_lock: asyncio.Lock = field(init=False, factory=asyncio.Lock)
+
+    def __attrs_post_init__(self) -> None:
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def _send(self, msqs: list[MassSaveQuery], token: str) -> list[pl.DataFrame]:
+        if len(msqs) == 1:
+            return [await msqs[0].run_query_async(token, self.session, self.cache, self.refresh)]
+        return await MassSaveBatch(msqs).run_queries_async(token, self.session, self.cache, self.refresh)
+
+    async def _token(self) -> str:
+        """The shared token, fetched by the first query to need one if the runner started without."""
+        async with self._refresh_lock:
+            if self.auth_token is None:
+                self.auth_token = await self.token_provider.get_token()
+            return self.auth_token
+
+    async def run(self, msqs: list[MassSaveQuery]) -> list[pl.DataFrame]:
+        """Run `msqs` as one request (a batch if there are several), returning a frame per query."""
+        async with self._semaphore:
+            token = await self._token()
+            try:
+                return await self._send(msqs, token)
+            except MassSaveAuthError:
+                async with self._refresh_lock:
+                    # Only the first query to hit the stale token scrapes a new one
+                    if self.auth_token == token:
+                        self.token_provider.invalidate()
+                        self.auth_token = await self.token_provider.refresh()
+                return await self._send(msqs, await self._token())
+
+
+def _response_cache(cache: ResponseCache | None, cache_mode: str | None) -> ResponseCache | None:
+    """The cache a download should go through for `cache_mode` (see download_masssave_data)."""
+    if cache_mode is None:
+        return cache
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Invalid cache_mode: {cache_mode}")  # noqa: TRY003
+    return None if cache_mode == "bypass" else (cache or ResponseCache())
+
+
+async def _prune_pending(
+    runner: _QueryRunner,
+    pending: list[tuple[tuple[MassSaveFilter, ...], list[str]]],
+    filter_sets: dict[str, list[str]],
+    sink: _ResultSink,
+    **query_options: Any,
+) -> tuple[list[tuple[tuple[MassSaveFilter, ...], list[str]]], dict[str, pl.DataFrame | None]]:
+    """Probe which combinations have installs, settling the queries that can't return rows as empty."""
+    try:
+        (probe,) = await runner.run([_probe_query(filter_sets, **query_options)])
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Probe query failed, querying every combination: {e}")
+        return pending, {}
+    keep, pruned = _prune_plan(pending, probe)
+    print(f"Probe found {probe.height} non-empty combinations; skipping {len(pruned)} of {len(pending)} queries")
+    return keep, {_combo_key(c): sink.done(c, pl.DataFrame()) for c, _ in pruned}
+
+
+@define()
+class DownloadJob:
+    """One table for download_many: which visual and filter combinations, and where the results go.
+
+    The fields mean what the download_masssave_data arguments of the same names do.
+    """
+
+    filter_sets: dict[str, list[str]] | None = None
+    spec: VisualSpec = field(default=RESIDENTIAL_ELECTRIFICATION)
+    outfile: str | None = None
+    run_dir: str | Path | None = None
+    resume: bool = False
+    mode: str = "combos"
+    cube_split_by: list[str] | None = None
+    parquet_dir: str | Path | None = None
+    batch_size: int = 1
+    prune: bool = False
+    typed: bool = False
+    window_count: int = DEFAULT_WINDOW_COUNT
+
+
+def job_from_dict(fields: dict[str, Any]) -> DownloadJob:
+    """A DownloadJob from its JSON form: the DownloadJob fields, with a "sector" in place of the spec."""
+    fields = dict(fields)
+    sector = fields.pop("sector", None)
+    if sector is not None:
+        fields["spec"] = electrification_spec(sector)
+    return DownloadJob(**fields)
+
+
+@define()
+class _ScheduledJob:
+    """A DownloadJob with its plan worked out and the queries it still needs to send."""
+
+    job: DownloadJob
+    filter_sets: dict[str, list[str]]
+    plan: list[tuple[tuple[MassSaveFilter, ...], list[str]]]
+    pending: list[tuple[tuple[MassSaveFilter, ...], list[str]]]
+    sink: _ResultSink
+
+    @classmethod
+    def schedule(cls, job: DownloadJob, checkpoint: RunCheckpoint | None) -> "_ScheduledJob":
+        filter_sets = job.filter_sets or DEFAULT_FILTER_SETS
+        plan = _plan_queries(filter_sets, job.mode, ["Year"] if job.cube_split_by is None else job.cube_split_by)
+        pending = [(c, g) for c, g in plan if checkpoint is None or checkpoint.status(c) not in ("done", "empty")]
+        if checkpoint is not None:
+            print(f"{len(plan) - len(pending)} of {len(plan)} combinations already done")
+        sink = _ResultSink([_filter_col(s) for s in filter_sets], checkpoint, job.parquet_dir, job.spec)
+        return cls(job, filter_sets, plan, pending, sink)
+
+    async def run(self, runner: _QueryRunner, **query_options: Any) -> pl.DataFrame:
+        """Run the pending queries through `runner` and assemble the job's table."""
+        job, sink = self.job, self.sink
+        query_options |= {"spec": job.spec, "window_count": job.window_count}
+        pending = self.pending
+        settled: dict[str, pl.DataFrame | None] = {}
+        if job.prune and pending:
+            pending, settled = await _prune_pending(runner, pending, self.filter_sets, sink, **query_options)
+
+        async def run_chunk(chunk: list[tuple[tuple[MassSaveFilter, ...], list[str]]]) -> list[pl.DataFrame | None]:
+            msqs = [MassSaveQuery(filters=list(c), group_by=g, **query_options) for c, g in chunk]
+            try:
+                dfs = await runner.run(msqs)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if sink.checkpoint is None:
+                    raise
+                for filter_combos, _ in chunk:
+                    sink.failed(filter_combos, e)
+                return [None] * len(chunk)
+            return [sink.done(c, df if df.is_empty() else _tag_combo(df, c, g)) for (c, g), df in zip(chunk, dfs)]
+
+        chunks = [pending[i : i + job.batch_size] for i in range(0, len(pending), job.batch_size)]
+        results = [df for dfs in await asyncio.gather(*(run_chunk(chunk) for chunk in chunks)) for df in dfs]
+
+        combos = [filter_combos for filter_combos, _ in self.plan]
+        results_by_combo = settled | {_combo_key(c): df for (c, _), df in zip(pending, results)}
+        data = sink.assemble(self.filter_sets, combos, results_by_combo)
+        if job.typed:
+            data = apply_schema(data, self.filter_sets, job.spec)
+        if job.outfile:
+            write_outfile(data, job.outfile)
+        return data
+
+
+def _schedule(jobs: dict[str, DownloadJob]) -> dict[str, _ScheduledJob]:
+    """Check every job before any query goes out, then open its checkpoint and plan its queries."""
+    for job in jobs.values():
+        if job.mode not in DOWNLOAD_MODES:
+            raise ValueError(f"Invalid mode: {job.mode}")  # noqa: TRY003
+        if job.window_count < 1:
+            raise ValueError(f"Invalid window_count: {job.window_count}")  # noqa: TRY003
+    run_dirs = [Path(job.run_dir).resolve() for job in jobs.values() if job.run_dir is not None]
+    if len(set(run_dirs)) < len(run_dirs):
+        raise ValueError("Every job needs a run_dir of its own")  # noqa: TRY003
+    return {name: _ScheduledJob.schedule(job, _open_checkpoint(job.run_dir, job.resume)) for name, job in jobs.items()}
+
+
+async def download_many_async(
+    jobs: dict[str, DownloadJob],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    auth_token: str | None = None,
+    token_provider: TokenProvider | None = None,
+    cache: ResponseCache | None = None,
+    cache_mode: str | None = None,
+    endpoint_url: str = QUERYDATA_URL,
+    hooks: list[Callable[[QueryMetrics], None]] | None = None,
+    report: bool = True,
+    retry: RetryPolicy | None = None,
+    rate_limiter: AdaptiveRateLimiter | None = None,
+) -> dict[str, pl.DataFrame]:
+    """Download several tables at once, returning each job's table under its name.
+
+    The queries of every job are scheduled together: they share one token (scraped at
+    most once, and refreshed once if the service rejects it), one pooled session with
+    its rate limiter, the response cache and the `max_concurrency` budget of requests
+    in flight. Jobs may read different visuals or sectors (see VisualSpec):
+
+        download_many({
+            "residential": DownloadJob(spec=electrification_spec("Residential")),
+            "commercial": DownloadJob(spec=electrification_spec("Commercial"), mode="cube"),
+        })
+
+    The other arguments mean what they do for download_masssave_data.
+    """
+    cache, refresh = _response_cache(cache, cache_mode), cache_mode == "refresh"
+    scheduled = _schedule(jobs)
+
+    # One token for every job, and none at all if everything is already done
+    token_provider = token_provider or TokenProvider()
+    if any(s.pending for s in scheduled.values()):
+        auth_token = auth_token or await token_provider.get_token()
+
+    recorder = MetricsRecorder()
+    hooks = [*(hooks or []), recorder]
+    with make_session(max_concurrency, retry, rate_limiter) as session:
+        runner = _QueryRunner(session, token_provider, auth_token, max_concurrency, cache, refresh)
+        tables = await asyncio.gather(
+            *(s.run(runner, endpoint_url=endpoint_url, hooks=hooks) for s in scheduled.values())
+        )
+    if report and recorder.records:
+        print(recorder.summary())
+        print(f"Request rate ended at {session.limiter.rate:.1f}/s")
+    return dict(zip(jobs, tables))
+
+
+def download_many(jobs: dict[str, DownloadJob], **options: Any) -> dict[str, pl.DataFrame]:
+    """Run download_many_async on its own event loop."""
+    return asyncio.run(download_many_async(jobs, **options))
+
+
+async def download_masssave_data_async(
+    outfile: str | None,
+    filter_sets: dict[str, list[str]] | None = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    auth_token: str | None = None,
+    token_provider: TokenProvider | None = None,
+    cache: ResponseCache | None = None,
+    cache_mode: str | None = None,
+    run_dir: str | Path | None = None,
+    resume: bool = False,
+    mode: str = "combos",
+    cube_split_by: list[str] | None = None,
+    parquet_dir: str | Path | None = None,
+    batch_size: int = 1,
+    endpoint_url: str = QUERYDATA_URL,
+    hooks: list[Callable[[QueryMetrics], None]] | None = None,
+    report: bool = True,
+    retry: RetryPolicy | None = None,
+    rate_limiter: AdaptiveRateLimiter | None = None,
+    prune: bool = False,
+    spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION,
+    typed: bool = False,
+    window_count: int = DEFAULT_WINDOW_COUNT,
+) -> pl.DataFrame:
+    """Download every combination of `filter_sets`, keeping up to `max_concurrency` queries in flight.
+
+    All queries share one pooled keep-alive session. Results are returned in the same
+    order as the sequential product loop, regardless of which query finishes first.
+    The token comes from `token_provider` (the on-disk cache by default) unless one is
+    passed in; if the service rejects it, a fresh one is scraped once and the query replayed.
+
+    Every query goes to the service unless a response cache is asked for; the counts of
+    recent years still change. `cache_mode` "use" answers unchanged queries from
+    `cache` (the on-disk ResponseCache if none is passed), "refresh" re-downloads and
+    overwrites them, and "bypass" neither reads nor writes it. Without a `cache_mode`,
+    passing a `cache` means "use" and not passing one means "bypass".
+
+    With a `run_dir`, every combination is checkpointed as it finishes and a failed
+    query is recorded rather than aborting the run. If any failed, nothing is assembled
+    and a MassSaveQueryError is raised; calling again with `resume=True` only runs the
+    combinations that are not done yet.
+
+    `mode="cube"` returns the same table from far fewer queries: every dimension not in
+    `cube_split_by` (default: Year) is projected as a grouping column, so there is one
+    query per value of the split dimensions rather than one per combination.
+
+    With a `parquet_dir`, each result is written into a Hive-partitioned Parquet dataset
+    (one directory level per filter column) as soon as it arrives instead of being held
+    in memory; the returned table is read back from it. See `scan_masssave`.
+
+    `batch_size` packs that many queries into each querydata POST (see MassSaveBatch);
+    `max_concurrency` then counts requests, not queries. `window_count` is the number of
+    rows per response page; cube queries return many more rows than a single
+    combination, so raising it saves them round trips. `endpoint_url` points the
+    queries at another querydata service, such as the local stand-in the tests use.
+
+    Every response page is reported to each of `hooks` as a QueryMetrics (sizes, status,
+    connect/first byte/download/decode times and the service's own execution metrics);
+    with `report`, a summary of them is printed once the download is done.
+
+    Throttled (429/503) and transiently failed requests are retried according to
+    `retry`, honouring Retry-After, and `rate_limiter` paces the requests: it speeds up
+    while the service keeps answering and halves its rate whenever it is throttled.
+
+    With `prune`, one coarse query over the filter dimensions (without the city) first
+    finds which combinations have any installs, and queries that can only come back
+    empty are skipped; they are recorded as empty like any other empty result.
+
+    `spec` picks the visual (and sector) to read; see VisualSpec. To download several
+    tables over the same token and connections, use download_many.
+
+    With `typed`, the table comes back in the compact schema of hp_adoption.masssave.schema
+    (integer year, Enum filter columns, Categorical municipality, Int32 counts) instead
+    of as text. An `outfile` ending in .arrow or .arrows is written as an Arrow IPC
+    stream rather than CSV.
+    """
+    job = DownloadJob(
+        filter_sets=filter_sets,
+        spec=spec,
+        outfile=outfile,
+        run_dir=run_dir,
+        resume=resume,
+        mode=mode,
+        cube_split_by=cube_split_by,
+        parquet_dir=parquet_dir,
+        batch_size=batch_size,
+        prune=prune,
+        typed=typed,
+        window_count=window_count,
+    )
+    tables = await download_many_async(
+        {spec.name: job},
+        max_concurrency=max_concurrency,
+        auth_token=auth_token,
+        token_provider=token_provider,
+        cache=cache,
+        cache_mode=cache_mode,
+        endpoint_url=endpoint_url,
+        hooks=hooks,
+        report=report,
+        retry=retry,
+        rate_limiter=rate_limiter,
+    )
+    return tables[spec.name]
+
+
+def download_masssave_data(
+    outfile: str | None,
+    filter_sets: dict[str, list[str]] | None = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    token_provider: TokenProvider | None = None,
+    cache: ResponseCache | None = None,
+    cache_mode: str | None = None,
+    run_dir: str | Path | None = None,
+    resume: bool = False,
+    mode: str = "combos",
+    cube_split_by: list[str] | None = None,
+    parquet_dir: str | Path | None = None,
+    batch_size: int = 1,
+    endpoint_url: str = QUERYDATA_URL,
+    hooks: list[Callable[[QueryMetrics], None]] | None = None,
+    report: bool = True,
+    retry: RetryPolicy | None = None,
+    rate_limiter: AdaptiveRateLimiter | None = None,
+    prune: bool = False,
+    spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION,
+    typed: bool = False,
+    window_count: int = DEFAULT_WINDOW_COUNT,
+) -> pl.DataFrame:
+    # One event loop for both the token scrape and the query fan-out
+    return asyncio.run(
+        download_masssave_data_async(
+            outfile,
+            filter_sets,
+            max_concurrency=max_concurrency,
+            token_provider=token_provider,
+            cache=cache,
+            cache_mode=cache_mode,
+            run_dir=run_dir,
+            resume=resume,
+            mode=mode,
+            cube_split_by=cube_split_by,
+            parquet_dir=parquet_dir,
+            batch_size=batch_size,
+            endpoint_url=endpoint_url,
+            hooks=hooks,
+            report=report,
+            retry=retry,
+            rate_limiter=rate_limiter,
+            prune=prune,
+            spec=spec,
+            typed=typed,
+            window_count=window_count,
+        )
+    )
+
+
+def write_outfile(data: pl.DataFrame, outfile: str | Path) -> None:
+    """Write a downloaded table to `outfile`: an Arrow IPC stream for the ARROW_SUFFIXES, CSV otherwise."""
+    if Path(outfile).suffix in ARROW_SUFFIXES:
+        write_ipc_stream(data, outfile)
+    else:
+        data.write_csv(outfile)
+
+
+def _snapshot_store(store_dir: str | Path, filter_sets: dict[str, list[str]]) -> SnapshotStore:
+    key = [*(_filter_col(col) for col in filter_sets), "municipality"]
+    return SnapshotStore(store_dir, key=key, partition_by=["year"])
+
+
+def import_masssave_snapshot(
+    store_dir: str | Path, csv_path: str | Path, version: str, filter_sets: dict[str, list[str]] | None = None
+) -> str:
+    """Add a dated CSV snapshot (like masssave_hpinstalls_20250701.csv) to the store as `version`."""
+    filter_sets = filter_sets or DEFAULT_FILTER_SETS
+    # Filter columns come back from the service as text, years included
+    df = pl.read_csv(csv_path, schema_overrides={_filter_col(col): pl.String for col in filter_sets})
+    return _snapshot_store(store_dir, filter_sets).commit(df, version, message=f"Imported from {csv_path}")
+
+
+def refresh_masssave_snapshot(
+    store_dir: str | Path,
+    filter_sets: dict[str, list[str]] | None = None,
+    mutable_years: list[str] | None = None,
+    version: str | None = None,
+    **download_options: Any,
+) -> str:
+    """Bring the snapshot store at `store_dir` up to date and return the new version.
+
+    Only `mutable_years` (by default the last DEFAULT_MUTABLE_YEARS of `filter_sets`) are
+    downloaded again; every other year is carried over from the latest version, so its
+    partitions are shared rather than stored twice. The first refresh of an empty store
+    downloads everything. `download_options` go to download_masssave_data; the point is
+    to pick up revisions, so the years are queried with cache_mode="refresh" unless
+    the options say otherwise.
+    """
+    filter_sets = filter_sets or DEFAULT_FILTER_SETS
+    download_options.setdefault("cache_mode", "refresh")
+    store = _snapshot_store(store_dir, filter_sets)
+    latest = store.latest()
+    years = filter_sets["Year"]
+    if latest is not None:
+        years = mutable_years or years[-DEFAULT_MUTABLE_YEARS:]
+    print(f"Downloading years {', '.join(years)}" + (f" on top of snapshot {latest}" if latest else ""))
+
+    fresh = download_masssave_data(None, filter_sets | {"Year": years}, **download_options)
+    if latest is not None:
+        kept = store.scan(latest).filter(~pl.col("year").is_in(years)).collect()
+        fresh = pl.concat([kept, fresh.select(kept.columns)])
+    version = store.commit(fresh, version, message=f"Refreshed years {', '.join(years)}")
+
+    counts = store.changes(latest, version)["change"].value_counts(sort=True).rows()
+    print(f"Snapshot {version}: " + (", ".join(f"{n} {change}" for change, n in counts) or "no changes"))
+    return version
@@ -0,0 +1,165 @@
+"""Ingest the Excel exports of the MassSave heat pump dashboard.
+
+Each export (e.g. `hvac_2022_retrofit_nodisplacement.xlsx`) holds one year and
+displaced fuel, named in the file name and repeated in an "applied filters" footer row.
+Workbooks are converted in a process pool and each one is cached as Parquet, keyed on
+its path, modification time and size, so a re-run only reads exports that are new or
+changed. The result has the same columns and types as the API downloader's, so the
+two sources can be concatenated directly:
+
+    df = ingest_masssave_excel("local_data/hvac_*.xlsx")
+
+Reading .xlsx files needs polars' Excel engine (fastexcel).
+"""
+
+import glob
+import hashlib
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import polars as pl
+
+from hp_adoption.masssave import cache
+
+CACHE_DIR = cache.CACHE_DIR / "masssave_excel"
+
+# Columns of the API downloader's output, in its order
+COLUMNS = {
+    "year": pl.String,
+    "displaced_fuel": pl.String,
+    "end_use": pl.String,
+    "rate_category": pl.String,
+    "municipality": pl.String,
+    "installed_hp_accounts": pl.Int64,
+    "installed_hp_locations": pl.Int64,
+}
+
+# How the file names spell the dashboard's filter values
+FILENAME_FUELS = {
+    "nodisplacement": "No displacement",
+    "electric": "Electric",
+    "propane": "Propane",
+    "other": "Other",
+    "gas": "Gas",
+    "oil": "Oil",
+}
+FILENAME_END_USES = {"hvac": "HVAC", "hotwater": "Hot Water", "hot_water": "Hot Water"}
+
+
+class MassSaveExcelError(ValueError):
+    """An export whose contents don't match what its file name says."""
+
+
+def parse_export_name(path: str | Path) -> dict[str, str]:
+    """The year, displaced fuel and end use an export's file name says it holds."""
+    name = Path(path).stem.lower()
+    year = re.search(r"\d{4}", name)
+    fuel = re.search("|".join(FILENAME_FUELS), name)
+    end_use = re.match("|".join(FILENAME_END_USES), name)
+    if year is None or fuel is None:
+        raise MassSaveExcelError(f"Can't tell the year and displaced fuel of {path} from its name")  # noqa: TRY003
+    return {
+        "year": year.group(0),
+        "displaced_fuel": FILENAME_FUELS[fuel.group(0)],
+        "end_use": FILENAME_END_USES[end_use.group(0)] if end_use else "HVAC",
+    }
+
+
+def clean_export(raw: pl.DataFrame, path: str | Path) -> pl.DataFrame:
+    """Turn a sheet as read from an export into rows shaped like the downloader's.
+
+    The footer row must name the same year and fuel as the file; it is dropped, as is
+    the "Total" row (the downloader leaves the subtotal out too). Suppressed counts
+    ("*") become null. Exports aren't split by rate category, so it is null: the rows
+    count every rate category together.
+    """
+    df = raw.select(
+        pl.col(raw.columns[0]).cast(pl.String).alias("municipality"),
+        pl.col(raw.columns[1]).cast(pl.String).alias("installed_hp_accounts"),
+        pl.col(raw.columns[2]).cast(pl.String).alias("installed_hp_locations"),
+    )
+    meta = parse_export_name(path)
+
+    applied_filters = (df["municipality"][-1] or "").lower().replace("no displacement", "nodisplacement")
+    fuel_name = next(k for k, v in FILENAME_FUELS.items() if v == meta["displaced_fuel"])
+    if f"year is {meta['year']}" not in applied_filters or f"displaced_fuel is {fuel_name}" not in applied_filters:
+        raise MassSaveExcelError(  # noqa: TRY003
+            f"{path} says year {meta['year']} and {fuel_name} but its filters are: {applied_filters}"
+        )
+
+    # Replace "*" only after the footer row is gone
+    counts = ["installed_hp_accounts", "installed_hp_locations"]
+    return (
+        df
+        .head(-1)
+        .filter(pl.col("municipality") != "Total")
+        .with_columns(pl.col(c).replace("*", None).cast(pl.Float64, strict=False).cast(pl.Int64) for c in counts)
+        .with_columns(pl.lit(v).alias(k) for k, v in meta.items())
+        .with_columns(rate_category=pl.lit(None, pl.String))
+        .select(pl.col(c).cast(dtype) for c, dtype in COLUMNS.items())
+    )
+
+
+def _cache_path(path: Path, cache_dir: Path) -> Path:
+    """Where the Parquet conversion of `path` goes; it changes whenever the file does."""
+    stat = path.stat()
+    name = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]
+    version = hashlib.sha256(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:16]
+    return cache_dir / f"{name}-{version}.parquet"
+
+
+def _convert(path: Path, cache_path: Path) -> Path:
+    """Read and clean one export into `cache_path`; runs in a worker process."""
+    df = clean_export(pl.read_excel(path), path)
+    tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    df.write_parquet(tmp)
+    os.replace(tmp, cache_path)
+    # Earlier conversions of the same file are stale now
+    for stale in cache_path.parent.glob(f"{cache_path.name.split('-')[0]}-*.parquet"):
+        if stale != cache_path:
+            stale.unlink(missing_ok=True)
+    return cache_path
+
+
+def _export_paths(sources: str | Path | list[str | Path]) -> list[Path]:
+    """Exports named by glob patterns, directories (every .xlsx in it) or plain paths."""
+    paths: list[Path] = []
+    for source in sources if isinstance(sources, list) else [sources]:
+        if Path(source).is_dir():
+            paths.extend(sorted(Path(source).glob("*.xlsx")))
+        else:
+            paths.extend(Path(p) for p in sorted(glob.glob(str(source))))
+    return paths
+
+
+def ingest_masssave_excel(
+    sources: str | Path | list[str | Path],
+    cache_dir: str | Path = CACHE_DIR,
+    max_workers: int | None = None,
+) -> pl.DataFrame:
+    """Read every export in `sources`, converting only those not already cached, and stack them.
+
+    New or changed workbooks are parsed in a pool of `max_workers` processes (one per
+    CPU by default); the rest are read straight from their cached Parquet files.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    paths = _export_paths(sources)
+    if not paths:
+        raise FileNotFoundError(f"No MassSave Excel exports found in {sources}")  # noqa: TRY003
+
+    cached = {path: _cache_path(path, cache_dir) for path in paths}
+    todo = [path for path, cache_path in cached.items() if not cache_path.exists()]
+    print(f"{len(paths) - len(todo)} of {len(paths)} exports cached; converting {len(todo)}")
+    if len(todo) == 1:
+        _convert(todo[0], cached[todo[0]])
+    elif todo:
+        # Forking a process whose polars thread pool is running can deadlock the child
+        with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # list() re-raises the first failed conversion here
+            list(pool.map(_convert, todo, [cached[path] for path in todo]))
+
+    return pl.scan_parquet(list(cached.values())).collect().sort("year", "displaced_fuel", "end_use", "municipality")
@@ -0,0 +1,126 @@
+"""Per-query telemetry: what each response page cost, from the client's side and the service's."""
+
+import threading
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from attrs import asdict, define
+
+if TYPE_CHECKING:
+    import polars as pl
+
+
+@define()
+class QueryMetrics:
+    """Telemetry for one response page of one query, handed to the download's `hooks`.
+
+    Client time is split into waiting (for the rate limiter and between retries),
+    connecting (None on a reused keep-alive connection or without a session), waiting
+    for the first byte, downloading the body and decoding it (JSON plus DSR).
+
+    `server_s` is the span of the execution events the service reports back because
+    the query asks for ExecutionMetricsKind 1; the events themselves are kept in
+    `server_metrics`. Queries sent together in one batch share the request's timings,
+    while the byte counts are each query's own part.
+    """
+
+    query: str
+    page: int = 0
+    batch_size: int = 1
+    cached: bool = False
+    status: int | None = None
+    retries: int = 0
+    wait_s: float = 0.0
+    payload_bytes: int = 0
+    response_bytes: int = 0
+    connect_s: float | None = None
+    ttfb_s: float | None = None
+    download_s: float | None = None
+    decode_s: float = 0.0
+    server_s: float | None = None
+    server_metrics: dict | None = None
+    error: str | None = None
+
+    def observe_result(self, result: dict) -> None:
+        """Pick the server's execution metrics out of a `results` entry."""
+        self.server_metrics = result.get("result", {}).get("data", {}).get("metrics")
+        events = (self.server_metrics or {}).get("Events") or []
+        spans = [
+            (datetime.fromisoformat(e["Start"]), datetime.fromisoformat(e["End"]))
+            for e in events
+            if "Start" in e and "End" in e
+        ]
+        if spans:
+            self.server_s = (max(end for _, end in spans) - min(start for start, _ in spans)).total_seconds()
+
+    def copy_request(self, other: "QueryMetrics") -> None:
+        """Share the timings of the request `other` describes (one batched POST)."""
+        self.status, self.connect_s, self.ttfb_s = other.status, other.connect_s, other.ttfb_s
+        self.retries, self.wait_s = other.retries, other.wait_s
+        self.download_s, self.decode_s = other.download_s, other.decode_s
+
+
+# Names of polars dtypes, looked up only once a frame is built so this module doesn't load polars
+_METRICS_SCHEMA = {
+    "query": "String",
+    "page": "Int64",
+    "batch_size": "Int64",
+    "cached": "Boolean",
+    "status": "Int64",
+    "retries": "Int64",
+    "wait_s": "Float64",
+    "payload_bytes": "Int64",
+    "response_bytes": "Int64",
+    "connect_s": "Float64",
+    "ttfb_s": "Float64",
+    "download_s": "Float64",
+    "decode_s": "Float64",
+    "server_s": "Float64",
+    "error": "String",
+}
+
+
+class MetricsRecorder:
+    """A hook that keeps every QueryMetrics it is given and summarises them."""
+
+    def __init__(self) -> None:
+        self.records: list[QueryMetrics] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, metrics: QueryMetrics) -> None:
+        # Hooks are called from the worker threads the queries run on
+        with self._lock:
+            self.records.append(metrics)
+
+    def frame(self) -> "pl.DataFrame":
+        import polars as pl
+
+        rows = [{k: v for k, v in asdict(m).items() if k != "server_metrics"} for m in self.records]
+        return pl.DataFrame(rows, schema={k: getattr(pl, dtype) for k, dtype in _METRICS_SCHEMA.items()})
+
+    def summary(self, slowest: int = 5) -> str:
+        """Counts, bytes, latency percentiles per phase and the slowest queries."""
+        import polars as pl
+
+        df = self.frame()
+        if df.is_empty():
+            return "No queries were sent"
+        sent = df.filter(~pl.col("cached"))
+        lines = [
+            f"{df.height} pages ({df['cached'].sum()} from cache, {df['retries'].sum()} retries, "
+            f"{df['error'].is_not_null().sum()} failed); "
+            f"{float(sent['payload_bytes'].sum()) / 1e3:.1f} kB sent, {float(sent['response_bytes'].sum()) / 1e6:.2f} MB received",
+            f"{'phase':<10} {'p50 s':>8} {'p95 s':>8} {'max s':>8}",
+        ]
+        for phase in ["wait_s", "connect_s", "ttfb_s", "download_s", "decode_s", "server_s"]:
+            values = sent[phase].drop_nulls() if phase != "decode_s" else df[phase]
+            if values.is_empty():
+                continue
+            p50, p95, top = values.quantile(0.5), values.quantile(0.95), values.quantile(1.0)
+            lines.append(f"{phase.removesuffix('_s'):<10} {p50:>8.3f} {p95:>8.3f} {top:>8.3f}")
+        total = pl.sum_horizontal(pl.col("wait_s", "connect_s", "ttfb_s", "download_s", "decode_s").fill_null(0))
+        lines.append("slowest:")
+        for row in df.with_columns(total_s=total).top_k(slowest, by="total_s").iter_rows(named=True):
+            server = "" if row["server_s"] is None else f", server {row['server_s']:.3f} s"
+            lines.append(f"  {row['total_s']:.3f} s  {row['query']} (page {row['page']}{server})")
+        return "\n".join(lines)
@@ -0,0 +1,97 @@
+"""Decoding querydata responses: Power BI's compressed DSR format into polars frames."""
+
+from typing import Any
+
+import polars as pl
+
+
+def _pbi_int(values: pl.Series) -> pl.Series:
+    # Power BI sends Int64 values either as JSON numbers or as strings like "19L"
+    if values.dtype.is_integer():
+        return values.cast(pl.Int64)
+    return values.cast(pl.String).str.strip_chars_end("L").cast(pl.Int64, strict=False)
+
+
+def _fill_repeats(values: pl.Series, repeated: pl.Series) -> pl.Series:
+    """Replace each repeated slot with the value of the last row that was sent."""
+    anchor = (
+        pl
+        .DataFrame({"repeated": repeated})
+        .select(pl.when(~pl.col("repeated")).then(pl.int_range(pl.len())).forward_fill())
+        .to_series()
+    )
+    return values.gather(anchor)
+
+
+def _dsr_frame(ds: dict, columns: list[str], n_text: int) -> pl.DataFrame:
+    """Decode the DM1 rows of a DSR data set straight into typed columns.
+
+    Power BI leaves a value out of a row's `C` when bit i of the row's `R` mask is set
+    (it repeats the row above) or bit i of its `Ø` mask is set (it is null). Cells are
+    scattered into one list per column, repeats are filled in vectorised, and columns
+    whose schema carries a `DN` are looked up in the data set's `ValueDicts`. The first
+    `n_text` columns are text, the rest Power BI integers.
+    """
+    schema = {name: pl.String if i < n_text else pl.Int64 for i, name in enumerate(columns)}
+    dm1: list[dict[str, Any]] = next((ph["DM1"] for ph in ds["PH"] if "DM1" in ph), [])
+    if not dm1:
+        return pl.DataFrame(schema=schema)
+
+    cells: list[list[Any]] = [[] for _ in columns]
+    repeat_masks = []
+    for item in dm1:
+        row = item.get("C", ())
+        repeat, null = item.get("R", 0), item.get("Ø", 0)
+        repeat_masks.append(repeat)
+        if not repeat and not null:
+            for column, value in zip(cells, row):
+                column.append(value)
+            continue
+        values = iter(row)
+        for i, column in enumerate(cells):
+            column.append(None if (repeat | null) >> i & 1 else next(values))
+
+    repeats = pl.Series(repeat_masks, dtype=pl.Int64)
+    value_dicts = ds.get("ValueDicts", {})
+    specs = dm1[0].get("S") or [{} for _ in columns]
+    series = []
+    for i, (name, column, spec) in enumerate(zip(columns, cells, specs)):
+        values = pl.Series(name, column, strict=False)
+        repeated = (repeats & (1 << i)) != 0
+        if repeated.any():
+            values = _fill_repeats(values, repeated)
+        if "DN" in spec:
+            values = pl.Series(name, value_dicts[spec["DN"]], strict=False).gather(values.cast(pl.UInt32))
+        values = values.cast(pl.String) if i < n_text else _pbi_int(values)
+        series.append(values.alias(name))
+    return pl.DataFrame(series)
+
+
+def _concat_pages(pages: list[pl.DataFrame]) -> pl.DataFrame:
+    non_empty = [df for df in pages if not df.is_empty()]
+    if not non_empty:
+        return pages[0]
+    return non_empty[0] if len(non_empty) == 1 else pl.concat(non_empty)
+
+
+def json_to_df(data: dict, columns: list[str] | None = None, n_text: int | None = None) -> pl.DataFrame:
+    """The rows of a single-query response, as `columns` (by default the city and the two measures).
+
+    The first `n_text` columns are text and the rest integers; by default all but the last two.
+    """
+    columns = columns or ["municipality", "installed_hp_accounts", "installed_hp_locations"]
+    ds = data["results"][0]["result"]["data"]["dsr"]["DS"][0]
+    return _dsr_frame(ds, columns, n_text=len(columns) - 2 if n_text is None else n_text)
+
+
+def json_to_total(data: dict) -> dict[str, int | None]:
+    """The DM0 subtotal of a response, i.e. the measures summed over every row."""
+    ds = data["results"][0]["result"]["data"]["dsr"]["DS"][0]
+    dm0: list[dict[str, Any]] = next((ph["DM0"] for ph in ds["PH"] if "DM0" in ph), [{}])
+    total = dm0[0] if dm0 else {}
+    values = total.get("C") or [total.get(f"M{i}") for i in range(2)]
+    values = [*values, None, None][:2]
+    return {
+        "installed_hp_accounts": _pbi_int(pl.Series([values[0]], strict=False))[0],
+        "installed_hp_locations": _pbi_int(pl.Series([values[1]], strict=False))[0],
+    }
@@ -0,0 +1,70 @@
+"""The typed schema of a downloaded table, and handing it over as Arrow.
+
+The service sends every column as text or int64, and a table of a few thousand rows
+repeats the same handful of filter values on every row. With `typed=True`,
+download_masssave_data returns the table in this schema instead:
+
+| column                                  | dtype       | values                                          |
+|-----------------------------------------|-------------|-------------------------------------------------|
+| year                                    | Int16       | the program year                                |
+| displaced_fuel, end_use, rate_category  | Enum        | the values of the filter set, sorted            |
+| municipality                            | Categorical | city names; the report's list isn't fixed       |
+| installed_hp_accounts/_locations        | Int32       | null where the report suppresses the number     |
+
+Every filter dimension of the download gets an Enum over the values it was queried
+with, so a value outside them is an error rather than a new category, and sorting on
+it sorts the text. Both Enum and Categorical columns leave polars as Arrow dictionary
+arrays: to_arrow and write_ipc_stream hand the buffers over as they are, so consumers
+join and aggregate on the dictionary codes without re-parsing strings.
+"""
+
+from typing import IO, TYPE_CHECKING
+
+import polars as pl
+
+from hp_adoption.masssave.query import DEFAULT_FILTER_SETS, _filter_col
+from hp_adoption.masssave.spec import RESIDENTIAL_ELECTRIFICATION, VisualSpec
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import pyarrow as pa
+
+YEAR_DTYPE = pl.Int16
+ROW_DTYPE = pl.Categorical()
+COUNT_DTYPE = pl.Int32
+
+# Output files with these suffixes are written as an Arrow IPC stream rather than CSV
+ARROW_SUFFIXES = [".arrow", ".arrows"]
+
+
+def masssave_schema(
+    filter_sets: dict[str, list[str]] | None = None, spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION
+) -> pl.Schema:
+    """The typed schema of a download of `filter_sets` from `spec` (see the module docstring)."""
+    filter_sets = filter_sets or DEFAULT_FILTER_SETS
+    schema: dict[str, pl.DataType | type[pl.DataType]] = {
+        _filter_col(col): YEAR_DTYPE if _filter_col(col) == "year" else pl.Enum(sorted(vals))
+        for col, vals in filter_sets.items()
+    }
+    schema |= {row.column: ROW_DTYPE for row in spec.rows}
+    schema |= {measure.column: COUNT_DTYPE for measure in spec.measures}
+    return pl.Schema(schema)
+
+
+def apply_schema(
+    df: pl.DataFrame, filter_sets: dict[str, list[str]] | None = None, spec: VisualSpec = RESIDENTIAL_ELECTRIFICATION
+) -> pl.DataFrame:
+    """Cast a downloaded table to masssave_schema; raises if a value doesn't fit its column."""
+    schema = masssave_schema(filter_sets, spec)
+    return df.cast({col: dtype for col, dtype in schema.items() if col in df.columns})
+
+
+def to_arrow(df: pl.DataFrame) -> "pa.Table":
+    """`df` as a pyarrow Table sharing its buffers; strings stay views and categories stay dictionaries."""
+    return df.to_arrow(compat_level=pl.CompatLevel.newest())
+
+
+def write_ipc_stream(df: pl.DataFrame, sink: "str | Path | IO[bytes]") -> None:
+    """Write `df` as an Arrow IPC stream, which pyarrow.ipc.open_stream (or pl.read_ipc_stream) reads back."""
+    df.write_ipc_stream(sink, compat_level=pl.CompatLevel.newest())
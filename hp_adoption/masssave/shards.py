@@ -0,0 +1,348 @@
+"""Splitting one download across workers: a work manifest, leases on its shards, and a merge.
+
+The filter product grows with every dimension, and past a few thousand queries one
+process can't get through it on one token. A WorkManifest cuts the product into
+shards by pinning the `shard_by` dimensions (Year by default) to one value each; every
+shard is an ordinary DownloadJob over the rest of the product. Any number of workers,
+in one process or on several machines sharing the manifest's directory, claim shards
+through lease files and write each shard's table next to the manifest:
+
+    python -m hp_adoption.masssave.shards create /shared/run --shard-by Year "End use"
+    python -m hp_adoption.masssave.shards work /shared/run     # on every machine, as often as you like
+    python -m hp_adoption.masssave.shards merge /shared/run masssave.csv
+
+Layout of the directory:
+
+- `manifest.json`: the filter sets, the download options and the list of shards
+- `leases/<shard>.lease`: who is working on a shard, and until when
+- `runs/<shard>/`: the RunCheckpoint of a shard in progress, so a worker that takes
+  over a shard whose lease ran out resumes it rather than starting again
+- `shards/<shard>.parquet`: a finished shard; its presence is what marks it done
+
+merge_shards concatenates the shard tables in product order, which gives the same
+sorted table download_masssave_data returns for the whole product. Shards are stored
+as text; with `typed`, the merged table is cast to the schema of the whole product.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import shutil
+import socket
+import time
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+from attrs import define, field
+
+from hp_adoption.masssave.auth import TokenProvider
+from hp_adoption.masssave.download import (
+    DOWNLOAD_MODES,
+    DownloadJob,
+    RunCheckpoint,
+    _combine,
+    _fsync,
+    download_many_async,
+    job_from_dict,
+    write_outfile,
+)
+from hp_adoption.masssave.query import DEFAULT_FILTER_SETS, MassSaveQueryError, _filter_col
+from hp_adoption.masssave.schema import apply_schema
+
+# A shard whose worker hasn't renewed its lease for this many seconds is up for grabs
+LEASE_TTL = 15 * 60
+
+# Download options a shard takes from the manifest; the outputs are the manifest's own
+SHARD_JOB_FIELDS = ["mode", "cube_split_by", "batch_size", "prune", "sector", "typed", "window_count"]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+@define()
+class WorkManifest:
+    """A download cut into shards, kept in `path` (see the module docstring for the layout)."""
+
+    path: Path = field(converter=Path)
+    filter_sets: dict[str, list[str]] = field(init=False)
+    shard_by: list[str] = field(init=False)
+    job: dict[str, Any] = field(init=False)
+    shards: dict[str, dict[str, str]] = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        manifest = json.loads((self.path / "manifest.json").read_text())
+        self.filter_sets = manifest["filter_sets"]
+        self.shard_by = manifest["shard_by"]
+        self.job = manifest["job"]
+        self.shards = {shard["id"]: shard["filters"] for shard in manifest["shards"]}
+
+    @classmethod
+    def create(
+        cls,
+        path: str | Path,
+        filter_sets: dict[str, list[str]] | None = None,
+        shard_by: list[str] | None = None,
+        **job: Any,
+    ) -> "WorkManifest":
+        """Write the manifest for the product of `filter_sets`, one shard per value of the `shard_by` dimensions.
+
+        `job` holds the download options every shard runs with (mode, cube_split_by,
+        batch_size, prune, sector, typed and window_count, as for download_masssave_data).
+        """
+        filter_sets = filter_sets or DEFAULT_FILTER_SETS
+        shard_by = ["Year"] if shard_by is None else shard_by
+        if unknown := [col for col in shard_by if col not in filter_sets]:
+            raise ValueError(f"Can only shard by the filter dimensions, not {unknown}")  # noqa: TRY003
+        if unknown := [key for key in job if key not in SHARD_JOB_FIELDS]:
+            raise ValueError(f"Shards don't take {unknown}")  # noqa: TRY003
+        if job.get("mode", "combos") not in DOWNLOAD_MODES:
+            raise ValueError(f"Invalid mode: {job['mode']}")  # noqa: TRY003
+
+        # In product order, so concatenating the shards keeps the order of the whole download
+        values = list(itertools.product(*(filter_sets[col] for col in shard_by)))
+        width = len(str(len(values) - 1))
+        shards = [{"id": f"{i:0{width}d}", "filters": dict(zip(shard_by, vals))} for i, vals in enumerate(values)]
+        manifest = {"filter_sets": filter_sets, "shard_by": shard_by, "job": job, "shards": shards}
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        target = path / "manifest.json"
+        if target.exists():
+            raise FileExistsError(f"{path} already holds a manifest")  # noqa: TRY003
+        tmp = path / "manifest.json.tmp"
+        tmp.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp, target)
+        return cls(path)
+
+    def shard_job(self, shard: str) -> DownloadJob:
+        """The DownloadJob that covers `shard`: the manifest's product with the shard's dimensions pinned."""
+        pinned = self.shards[shard]
+        filter_sets = {col: [pinned[col]] if col in pinned else vals for col, vals in self.filter_sets.items()}
+        run_dir = self.path / "runs" / shard
+        return job_from_dict({
+            **self.job,
+            # Typed, a shard's Enums would only hold its pinned values; merge_shards types the whole table
+            "typed": False,
+            "filter_sets": filter_sets,
+            "run_dir": run_dir,
+            "resume": RunCheckpoint(run_dir).exists(),
+        })
+
+    def _output(self, shard: str) -> Path:
+        return self.path / "shards" / f"{shard}.parquet"
+
+    def _lease(self, shard: str) -> Path:
+        return self.path / "leases" / f"{shard}.lease"
+
+    def is_done(self, shard: str) -> bool:
+        return self._output(shard).exists()
+
+    def holder(self, shard: str) -> dict[str, Any] | None:
+        """The worker holding the lease on `shard` and when it runs out, if anyone holds it."""
+        try:
+            lease: dict[str, Any] = json.loads(self._lease(shard).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        return lease
+
+    def _write_lease(self, shard: str, worker: str, ttl: float) -> Path:
+        """A complete lease file for `worker`, next to where the lease goes."""
+        lease = self._lease(shard)
+        lease.parent.mkdir(parents=True, exist_ok=True)
+        tmp = lease.with_name(f"{lease.name}.{worker}.tmp")
+        tmp.write_text(json.dumps({"worker": worker, "expires": time.time() + ttl}))
+        return tmp
+
+    def acquire(self, shard: str, worker: str, ttl: float = LEASE_TTL) -> bool:
+        """Try to take the lease on `shard`; only one of any number of workers trying at once gets it."""
+        lease = self._lease(shard)
+        tmp = self._write_lease(shard, worker, ttl)
+        try:
+            # Linking fails if the lease exists, so of several workers exactly one wins,
+            # and nobody ever reads a half-written lease
+            os.link(tmp, lease)
+        except FileExistsError:
+            holder = self.holder(shard)
+            if holder is None or holder["expires"] > time.time() or not self._break(shard, holder, worker):
+                return False
+            return self.acquire(shard, worker, ttl)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return True
+
+    def _break(self, shard: str, expired: dict[str, Any], worker: str) -> bool:
+        """Remove the lease `expired` from `shard`, unless someone else got there first."""
+        lease = self._lease(shard)
+        moved = lease.with_name(f"{lease.name}.{worker}.stale")
+        try:
+            os.rename(lease, moved)
+        except FileNotFoundError:
+            return False
+        try:
+            if json.loads(moved.read_text()) == expired:
+                return True
+            # Another worker broke the lease and took the shard in the meantime: put its lease back
+            with contextlib.suppress(FileExistsError):
+                os.link(moved, lease)
+            return False
+        finally:
+            moved.unlink()
+
+    def renew(self, shard: str, worker: str, ttl: float = LEASE_TTL) -> bool:
+        """Push back the expiry of `worker`'s lease on `shard`; False if the lease is no longer its own."""
+        holder = self.holder(shard)
+        if holder is None or holder["worker"] != worker:
+            return False
+        os.replace(self._write_lease(shard, worker, ttl), self._lease(shard))
+        return True
+
+    def release(self, shard: str, worker: str) -> None:
+        holder = self.holder(shard)
+        if holder is not None and holder["worker"] == worker:
+            self._lease(shard).unlink(missing_ok=True)
+
+    def claim(self, worker: str, ttl: float = LEASE_TTL, skip: set[str] | frozenset[str] = frozenset()) -> str | None:
+        """Lease the first shard that isn't done or leased (nor in `skip`), or return None if there is none."""
+        for shard in self.shards:
+            if shard not in skip and not self.is_done(shard) and self.acquire(shard, worker, ttl):
+                # It may have been finished between the check and the lease
+                if not self.is_done(shard):
+                    return shard
+                self.release(shard, worker)
+        return None
+
+    def write_shard(self, shard: str, df: pl.DataFrame) -> None:
+        output = self._output(shard)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = output.with_suffix(".tmp")
+        df.write_parquet(tmp)
+        _fsync(tmp)
+        os.replace(tmp, output)
+        # The checkpoint only matters until the shard is done
+        shutil.rmtree(self.path / "runs" / shard, ignore_errors=True)
+
+    def status(self) -> dict[str, str]:
+        """Every shard's state: done, leased (by a live lease), expired or pending."""
+        states = {}
+        for shard in self.shards:
+            holder = self.holder(shard)
+            if self.is_done(shard):
+                states[shard] = "done"
+            elif holder is None:
+                states[shard] = "pending"
+            else:
+                states[shard] = "leased" if holder["expires"] > time.time() else "expired"
+        return states
+
+
+async def _keep_lease(manifest: WorkManifest, shard: str, worker: str, ttl: float) -> None:
+    while True:
+        await asyncio.sleep(ttl / 3)
+        if not manifest.renew(shard, worker, ttl):
+            print(f"Lost the lease on shard {shard}")
+            return
+
+
+async def run_worker_async(
+    path: str | Path,
+    worker: str | None = None,
+    ttl: float = LEASE_TTL,
+    max_shards: int | None = None,
+    token_provider: TokenProvider | None = None,
+    **options: Any,
+) -> dict[str, list[str]]:
+    """Claim and download shards of the manifest in `path` until none are left (or `max_shards` are done).
+
+    `options` go to download_many (max_concurrency, cache, endpoint_url, ...); every
+    shard this worker runs shares its token provider. A shard that fails is released
+    for another worker, and skipped by this one. Returns the shards done and failed.
+    """
+    manifest = WorkManifest(path)
+    worker = worker or default_worker_id()
+    token_provider = token_provider or TokenProvider()
+    done: list[str] = []
+    failed: list[str] = []
+    while max_shards is None or len(done) < max_shards:
+        shard = manifest.claim(worker, ttl, skip=set(failed))
+        if shard is None:
+            break
+        print(f"{worker}: shard {shard} ({manifest.shards[shard]})")
+        keeper = asyncio.create_task(_keep_lease(manifest, shard, worker, ttl))
+        try:
+            tables = await download_many_async(
+                {shard: manifest.shard_job(shard)}, token_provider=token_provider, **options
+            )
+            manifest.write_shard(shard, tables[shard])
+            done.append(shard)
+        except MassSaveQueryError as e:
+            print(f"{worker}: shard {shard} failed: {e}")
+            failed.append(shard)
+        finally:
+            keeper.cancel()
+            manifest.release(shard, worker)
+    return {"done": done, "failed": failed}
+
+
+def run_worker(path: str | Path, **options: Any) -> dict[str, list[str]]:
+    """Run run_worker_async on its own event loop."""
+    return asyncio.run(run_worker_async(path, **options))
+
+
+def merge_shards(path: str | Path, outfile: str | None = None) -> pl.DataFrame:
+    """The whole table from the finished shards in `path`, as download_masssave_data would have returned it."""
+    manifest = WorkManifest(path)
+    if missing := [shard for shard in manifest.shards if not manifest.is_done(shard)]:
+        raise MassSaveQueryError(f"{len(missing)} of {len(manifest.shards)} shards are not done: {missing}")  # noqa: TRY003
+    job = job_from_dict(manifest.job)
+    dfs = [pl.read_parquet(manifest._output(shard)) for shard in manifest.shards]
+    data = _combine(
+        [df for df in dfs if not df.is_empty()], [_filter_col(col) for col in manifest.filter_sets], job.spec
+    )
+    if job.typed:
+        data = apply_schema(data, manifest.filter_sets, job.spec)
+    if outfile:
+        write_outfile(data, outfile)
+    return data
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="write a manifest for the default filter sets")
+    create.add_argument("path", type=Path)
+    create.add_argument("--shard-by", nargs="+", default=["Year"])
+    create.add_argument("--mode", choices=DOWNLOAD_MODES, default="combos")
+    create.add_argument("--sector", default="Residential")
+    create.add_argument("--typed", action="store_true", help="merge into the compact schema")
+    work = commands.add_parser("work", help="download shards until none are left")
+    work.add_argument("path", type=Path)
+    work.add_argument("--worker")
+    work.add_argument("--max-shards", type=int)
+    merge = commands.add_parser("merge", help="write the merged table")
+    merge.add_argument("path", type=Path)
+    merge.add_argument("outfile")
+    status = commands.add_parser("status", help="count the shards by state")
+    status.add_argument("path", type=Path)
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        manifest = WorkManifest.create(
+            args.path, shard_by=args.shard_by, mode=args.mode, sector=args.sector, typed=args.typed
+        )
+        print(f"{len(manifest.shards)} shards in {args.path}")
+    elif args.command == "work":
+        print(run_worker(args.path, worker=args.worker, max_shards=args.max_shards))
+    elif args.command == "merge":
+        print(merge_shards(args.path, args.outfile))
+    else:
+        states = list(WorkManifest(args.path).status().values())
+        print({state: states.count(state) for state in dict.fromkeys(states)})
+
+
+if __name__ == "__main__":
+    main()
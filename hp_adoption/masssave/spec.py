@@ -0,0 +1,166 @@
+"""Declarative descriptions of the report's visuals: what a query selects, from where, under which conditions.
+
+A VisualSpec holds everything that pins a MassSaveQuery to one visual of one model:
+the entities, the row and measure projections, the fixed conditions and the IDs the
+service wants in the application context. The default is the Residential
+Electrification table; other sectors only swap a condition:
+
+    commercial = electrification_spec(sector="Commercial")
+    MassSaveQuery(filters=[...], spec=commercial)
+
+Another visual of the same report is a new VisualSpec with its own projections and
+visual ID; the queries, batching and download machinery stay the same.
+"""
+
+from functools import cached_property
+from typing import Any
+
+from attrs import define, field
+from attrs.validators import in_
+
+DATASET_ID = "35b53c35-e590-4b77-8b00-b6cf403eff38"
+REPORT_ID = "bdc9170f-1a7e-44d2-be94-98e07915d04c"
+MODEL_ID = 2256951
+ELECTRIFICATION_VISUAL_ID = "ecc58064d3cee7a05d02"
+
+# What Power BI calls the sectors of the report's Dim_Sector
+SECTORS = ["Residential", "Commercial", "Industrial"]
+
+
+def _column(source: str, prop: str) -> dict[str, Any]:
+    return {"Column": {"Expression": {"SourceRef": {"Source": source}}, "Property": prop}}
+
+
+def in_condition(source: str, prop: str, literal: str, negate: bool = False) -> dict[str, Any]:
+    """A fixed Where condition: `prop` of `source` equal to the Power BI `literal` (e.g. "'City'" or "1L")."""
+    cond = {"In": {"Expressions": [_column(source, prop)], "Values": [[{"Literal": {"Value": literal}}]]}}
+    return {"Condition": {"Not": {"Expression": cond}} if negate else cond}
+
+
+@define()
+class Projection:
+    """One column of a visual's result: a Column or Measure property of one of its entities.
+
+    `name` is Power BI's "Entity.Property" name for it, `column` the name it gets in the
+    decoded frame.
+    """
+
+    source: str
+    prop: str
+    name: str
+    column: str
+    kind: str = field(default="Column", validator=in_(["Column", "Measure"]))
+    native_name: str | None = None
+
+    def select(self) -> dict[str, Any]:
+        select = {
+            self.kind: {"Expression": {"SourceRef": {"Source": self.source}}, "Property": self.prop},
+            "Name": self.name,
+        }
+        if self.native_name is not None:
+            select["NativeReferenceName"] = self.native_name
+        return select
+
+    def order(self) -> dict[str, Any]:
+        return {"Direction": 1, "Expression": _column(self.source, self.prop)}
+
+
+@define()
+class VisualSpec:
+    """The fixed part of every query against one visual.
+
+    `entities` maps the source names the projections and conditions refer to onto the
+    model's entities. `rows` are the text columns a result is split by (the city),
+    `measures` the integer columns summed over them; queries may leave the rows out to
+    get totals only.
+    """
+
+    name: str
+    entities: dict[str, str]
+    rows: list[Projection]
+    measures: list[Projection]
+    conditions: list[dict[str, Any]]
+    visual_id: str
+    report_id: str = REPORT_ID
+    dataset_id: str = DATASET_ID
+    model_id: int = MODEL_ID
+
+    def from_entities(self) -> list[dict[str, Any]]:
+        return [{"Name": source, "Entity": entity, "Type": 0} for source, entity in self.entities.items()]
+
+    def application_context(self) -> dict[str, Any]:
+        return {"DatasetId": self.dataset_id, "Sources": [{"ReportId": self.report_id, "VisualId": self.visual_id}]}
+
+    @cached_property
+    def template(self) -> dict[str, Any]:
+        """The parts of the query every query against the visual shares, built once per spec.
+
+        "From" and "Where" are the entities and conditions, "Rows" and "Measures" the
+        Select entries of the projections, "OrderBy" the rows' ordering. Queries copy
+        these lists rather than change them, and a spec is not changed once it is queried.
+        """
+        return {
+            "From": self.from_entities(),
+            "Where": list(self.conditions),
+            "Rows": [p.select() for p in self.rows],
+            "Measures": [p.select() for p in self.measures],
+            "OrderBy": [p.order() for p in self.rows],
+            "ApplicationContext": self.application_context(),
+        }
+
+
+def electrification_spec(sector: str = "Residential") -> VisualSpec:
+    """The heat pump installs by city table, for `sector`, with suppression switched off."""
+    if sector not in SECTORS:
+        raise ValueError(f"Invalid sector: {sector}")  # noqa: TRY003
+    return VisualSpec(
+        name=f"{sector.lower()}_electrification",
+        entities={
+            "f": "Fact",
+            "s": "Suppression table",
+            "a": "ACS",
+            "s1": "Suppression global switch",
+            "s2": "Suppression style",
+            "n": "New Construction Rule",
+            "s3": "Suppression display control",
+            "c": "Dim_City",
+            "h": "Dim_Heat_pump",
+            "s4": "Dim_Sector",
+        },
+        rows=[Projection("c", "City", "Dim_City.City", "municipality", native_name="Municipality")],
+        measures=[
+            Projection(
+                "f",
+                "Participants",
+                "Fact.Participants",
+                "installed_hp_accounts",
+                kind="Measure",
+                native_name="Installed heat pumps (accounts)1",
+            ),
+            Projection(
+                "f",
+                "Participanting locations",
+                "Fact.Participanting locations",
+                "installed_hp_locations",
+                kind="Measure",
+                native_name="Installed heat pumps (locations)",
+            ),
+        ],
+        conditions=[
+            in_condition("s", "Suppression option", "'City'"),
+            in_condition("h", "Heat_pump", "'Energy efficiency'", negate=True),
+            in_condition("s4", "Sector", f"'{sector}'"),
+            in_condition("f", "Is_track_new_meas", "1L"),
+            in_condition("h", "Heat_pump", "'No heat pump'", negate=True),
+            ## IMPORTANT: Suppression status is OFF
+            in_condition("s1", "Suppression status", "'Suppression OFF'"),
+            in_condition("s2", "Option", "'*'"),
+            in_condition("n", "New_Construction_Rule", "true"),
+            # This could maybe flip to False? It doesn't appear to affect the results
+            in_condition("s3", "Suppression_visible", "false"),
+        ],
+        visual_id=ELECTRIFICATION_VISUAL_ID,
+    )
+
+
+RESIDENTIAL_ELECTRIFICATION = electrification_spec()
@@ -0,0 +1,242 @@
+"""The HTTP side of the client: pooled sessions, pacing, retries and the querydata POST itself."""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any
+
+import requests
+from attrs import define, field
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+from hp_adoption.masssave.metrics import QueryMetrics
+from hp_adoption.masssave.query import MassSaveAuthError, MassSaveQueryError
+
+SHARED_HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "accept-encoding": "gzip, deflate, br, zstd",
+    "accept-language": "en-US,en;q=0.9",
+    "content-type": "application/json;charset=UTF-8",
+    "origin": "https://app.powerbi.com",
+    "referer": "https://app.powerbi.com/",
+    "sec-ch-ua": '"Google Chrome";v="137", "Chromium";v="137", "Not/A)Brand";v="24"',
+    "sec-ch-ua-mobile": "?0",
+    "sec-ch-ua-platform": '"macOS"',
+    "sec-fetch-dest": "empty",
+    "sec-fetch-mode": "cors",
+    "sec-fetch-site": "cross-site",
+    "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36",
+    "x-powerbi-hostenv": "Embed for Customers",
+}
+
+
+# Number of querydata requests kept in flight at once
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+# Responses worth another attempt, and the subset that means the service wants us slower
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUSES = frozenset({429, 503})
+
+
+# What the current thread's request spent connecting (see _TimingAdapter), retrying and
+# waiting for the rate limiter (see ResilientSession); _post reads it into QueryMetrics
+_transport_stats = threading.local()
+
+
+def _reset_transport_stats() -> None:
+    _transport_stats.connect, _transport_stats.retries, _transport_stats.wait = None, 0, 0.0
+
+
+class _ConnectTimer(HTTPConnection):
+    def connect(self) -> None:
+        start = time.perf_counter()
+        super().connect()
+        _transport_stats.connect = (getattr(_transport_stats, "connect", None) or 0.0) + time.perf_counter() - start
+
+
+def _timed_pool(pool_cls: type[HTTPConnectionPool]) -> type[HTTPConnectionPool]:
+    connection_cls = type(f"Timed{pool_cls.ConnectionCls.__name__}", (_ConnectTimer, pool_cls.ConnectionCls), {})
+    return type(f"Timed{pool_cls.__name__}", (pool_cls,), {"ConnectionCls": connection_cls})
+
+
+class _TimingAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connections note how long connecting (and the TLS handshake) took."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        pools = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {scheme: _timed_pool(cls) for scheme, cls in pools.items()}
+
+
+@define()
+class RetryPolicy:
+    """Which failed requests to try again, and how long to wait before each new attempt.
+
+    The wait is drawn uniformly from zero up to `base_delay` doubled per attempt (capped
+    at `max_delay`), so retrying clients spread out instead of returning in lockstep. A
+    `Retry-After` header on the response takes precedence.
+    """
+
+    max_attempts: int = 6
+    base_delay: float = 0.5
+    max_delay: float = 60.0
+    statuses: frozenset[int] = field(default=RETRY_STATUSES, converter=frozenset)
+
+    def delay(self, attempt: int, retry_after: str | None = None) -> float:
+        """Seconds to wait after the `attempt`-th (from 0) attempt failed."""
+        if retry_after is not None:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(max(seconds, 0.0), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))  # noqa: S311
+
+
+@define()
+class AdaptiveRateLimiter:
+    """Lets requests through at `rate` per second on average, adjusting the rate AIMD style.
+
+    Up to `burst` requests may go at once before the pacing kicks in. Every successful
+    response raises the rate by `increase / rate`, i.e. by about `increase` requests/s
+    per second of traffic; a throttling response multiplies it by `decrease`. Cuts are
+    at most one per `cooldown` seconds, so a burst of throttled requests that were
+    already in flight only counts once.
+    """
+
+    rate: float = 50.0
+    burst: int = 10
+    min_rate: float = 0.2
+    max_rate: float = 1000.0
+    increase: float = 10.0
+    decrease: float = 0.5
+    cooldown: float = 1.0
+    # When the next request would be due if every one so far had been spaced out evenly
+    _due: float = field(init=False, default=0.0)
+    _last_cut: float = field(init=False, default=float("-inf"))
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def acquire(self) -> float:
+        """Wait until the next request may go and return how long that took."""
+        with self._lock:
+            now = time.monotonic()
+            due = max(self._due, now)
+            wait = max(0.0, due - now - (self.burst - 1) / self.rate)
+            self._due = due + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_cut >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_cut = now
+
+
+class ResilientSession(requests.Session):
+    """A requests.Session that paces requests through a rate limiter and retries failed ones.
+
+    Connection errors, timeouts and the policy's statuses (throttling and transient
+    server errors) are retried after the policy's delay; 429/503 also slow the limiter
+    down. The last response is returned as is once the attempts run out, so the caller
+    still sees the status.
+    """
+
+    def __init__(self, retry: RetryPolicy | None = None, limiter: AdaptiveRateLimiter | None = None):
+        super().__init__()
+        self.retry = retry or RetryPolicy()
+        self.limiter = limiter or AdaptiveRateLimiter()
+
+    def _attempt(self, method: str | bytes, url: str | bytes, *args: Any, **kwargs: Any) -> requests.Response:
+        _transport_stats.wait = getattr(_transport_stats, "wait", 0.0) + self.limiter.acquire()
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code in THROTTLE_STATUSES:
+            self.limiter.on_throttle()
+        elif response.status_code < 400:
+            self.limiter.on_success()
+        return response
+
+    def request(self, method: str | bytes, url: str | bytes, *args: Any, **kwargs: Any) -> requests.Response:
+        for attempt in range(self.retry.max_attempts - 1):
+            try:
+                response = self._attempt(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self.retry.delay(attempt)
+            else:
+                if response.status_code not in self.retry.statuses:
+                    return response
+                delay = self.retry.delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            _transport_stats.retries = getattr(_transport_stats, "retries", 0) + 1
+            _transport_stats.wait += delay
+            time.sleep(delay)
+        return self._attempt(method, url, *args, **kwargs)
+
+
+def make_session(
+    pool_size: int = DEFAULT_MAX_CONCURRENCY,
+    retry: RetryPolicy | None = None,
+    limiter: AdaptiveRateLimiter | None = None,
+) -> ResilientSession:
+    """Create a keep-alive session whose connection pool can serve `pool_size` concurrent queries.
+
+    Requests through it are paced by `limiter` and retried according to `retry`.
+    """
+    session = ResilientSession(retry, limiter)
+    adapter = _TimingAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _post(
+    endpoint_url: str,
+    body: bytes,
+    token: str,
+    session: requests.Session | None = None,
+    metrics: QueryMetrics | None = None,
+) -> bytes:
+    """POST an already serialized querydata body and return the raw response bytes.
+
+    With `metrics`, the status, sizes and connect/first byte/download times are recorded
+    on it, including when the request fails.
+    """
+    headers = SHARED_HEADERS | {"authorization": f"EmbedToken {token}"}
+
+    # Reuse the caller's pooled keep-alive connection when there is one
+    post = session.post if session is not None else requests.post
+    _reset_transport_stats()
+    start = time.perf_counter()
+    # Streamed, so the call returns once the headers are in and the body is timed separately
+    response = post(endpoint_url, headers=headers, data=body, timeout=30, stream=True)
+    first_byte = time.perf_counter()
+    content = response.content
+    if metrics is not None:
+        connect, wait = _transport_stats.connect, _transport_stats.wait
+        metrics.status = response.status_code
+        metrics.payload_bytes, metrics.response_bytes = len(body), len(content)
+        metrics.retries, metrics.wait_s, metrics.connect_s = _transport_stats.retries, wait, connect
+        metrics.ttfb_s = first_byte - start - wait - (connect or 0.0)
+        metrics.download_s = time.perf_counter() - first_byte
+
+    if response.status_code in (401, 403):
+        raise MassSaveAuthError(f"EmbedToken rejected with HTTP {response.status_code}")  # noqa: TRY003
+    if response.status_code != 200:
+        # A failed query must not look like an empty result further down
+        raise MassSaveQueryError(f"HTTP {response.status_code}: {response.text[:500]}")  # noqa: TRY003
+    return content
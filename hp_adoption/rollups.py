@@ -0,0 +1,190 @@
+"""Pre-aggregated rollups of the MassSave heat pump counts.
+
+A RollupCube stores the measures summed over every subset of the dimensions (32
+rollups for the downloader's five), each as a Parquet file. A query is answered from
+the smallest rollup that still has the dimensions it groups or filters by, so totals
+by year and fuel never touch the municipality-level rows:
+
+    cube = RollupCube("data/ma/rollups")
+    cube.update(store)  # store: the SnapshotStore the downloader refreshes
+    cube.query(["year", "displaced_fuel"]).pivot("year", index="displaced_fuel", values="installed_hp_locations")
+
+When a new snapshot lands, `update` reads only its changes from the store and adds
+them to every rollup rather than aggregating the whole table again.
+
+Suppressed (null) counts add nothing to the sums.
+"""
+
+import itertools
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+from attrs import define, field
+
+from hp_adoption.snapshots import SnapshotStore
+
+DIMENSIONS = ["year", "displaced_fuel", "end_use", "rate_category", "municipality"]
+MEASURES = ["installed_hp_accounts", "installed_hp_locations"]
+
+# How many rows of the base table each rollup group sums; a group whose rows have all
+# been removed is dropped
+ROWS = "base_rows"
+
+
+def _rollup_name(dims: tuple[str, ...]) -> str:
+    return "+".join(dims) or "all"
+
+
+def _aggregate(df: pl.DataFrame, dims: tuple[str, ...], measures: list[str]) -> pl.DataFrame:
+    """Sum `measures` and ROWS over `dims` (over everything for no dims)."""
+    sums = [pl.col(c).sum() for c in [*measures, ROWS]]
+    if not dims:
+        return df.select(sums)
+    return df.group_by(dims).agg(sums).sort(dims, nulls_last=True)
+
+
+@define()
+class RollupCube:
+    """Rollups of `measures` over every subset of `dimensions`, stored under `root`.
+
+    `cube.json` names the snapshot version the rollups reflect and the directory that
+    holds them; each update writes a new directory and switches to it last, so readers
+    never see rollups from two versions.
+    """
+
+    root: Path = field(converter=Path)
+    dimensions: list[str] = field(factory=lambda: list(DIMENSIONS))
+    measures: list[str] = field(factory=lambda: list(MEASURES))
+
+    @property
+    def state_path(self) -> Path:
+        return self.root / "cube.json"
+
+    def state(self) -> dict[str, Any] | None:
+        return json.loads(self.state_path.read_text()) if self.state_path.exists() else None
+
+    @property
+    def version(self) -> str | None:
+        """The snapshot version the rollups were built from."""
+        state = self.state()
+        version: str | None = state["version"] if state is not None else None
+        return version
+
+    def _subsets(self) -> list[tuple[str, ...]]:
+        """Every subset of the dimensions, largest first, each in the dimensions' order."""
+        n = len(self.dimensions)
+        return [dims for size in range(n, -1, -1) for dims in itertools.combinations(self.dimensions, size)]
+
+    def _rollup_path(self, dims: tuple[str, ...], state: dict[str, Any] | None = None) -> Path:
+        state = state or self.state()
+        if state is None:
+            raise FileNotFoundError(f"No rollups built in {self.root}")  # noqa: TRY003
+        directory: str = state["directory"]
+        return self.root / directory / f"{_rollup_name(dims)}.parquet"
+
+    def build(self, df: pl.DataFrame, version: str | None = None) -> None:
+        """Aggregate `df` (the snapshot `version`) into every rollup, replacing the current ones.
+
+        Each rollup is summed from the smallest one already built that has one more
+        dimension, so only the first reads the whole table.
+        """
+        base = tuple(self.dimensions)
+        rollups = {base: _aggregate(df.with_columns(pl.lit(1, pl.Int64).alias(ROWS)), base, self.measures)}
+        for dims in self._subsets()[1:]:
+            parents = [p for p in rollups if len(p) == len(dims) + 1 and set(dims) <= set(p)]
+            parent = min(parents, key=lambda p: rollups[p].height)
+            rollups[dims] = _aggregate(rollups[parent], dims, self.measures)
+        self._write(rollups, version)
+
+    def _write(self, rollups: dict[tuple[str, ...], pl.DataFrame], version: str | None) -> None:
+        old = self.state()
+        directory = f"rollups-{version or 'unversioned'}"
+        if old is not None and old["directory"] == directory:
+            directory += "-1"
+        state = {
+            "version": version,
+            "directory": directory,
+            "dimensions": self.dimensions,
+            "measures": self.measures,
+            "rollups": {_rollup_name(dims): df.height for dims, df in rollups.items()},
+        }
+        for dims, df in rollups.items():
+            path = self._rollup_path(dims, state)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            df.write_parquet(path)
+        tmp = self.state_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, indent=1))
+        os.replace(tmp, self.state_path)
+        if old is not None:
+            shutil.rmtree(self.root / old["directory"], ignore_errors=True)
+
+    def read(self, dims: list[str] | tuple[str, ...]) -> pl.DataFrame:
+        """The rollup over exactly `dims`, with its ROWS column."""
+        return pl.read_parquet(self._rollup_path(tuple(d for d in self.dimensions if d in dims)))
+
+    def covering_rollup(self, dims: set[str]) -> tuple[str, ...]:
+        """The rollup with the fewest rows among those that have all of `dims`."""
+        state = self.state()
+        if state is None:
+            raise FileNotFoundError(f"No rollups built in {self.root}")  # noqa: TRY003
+        unknown = dims - set(self.dimensions)
+        if unknown:
+            raise ValueError(f"Not dimensions of the cube: {', '.join(sorted(unknown))}")  # noqa: TRY003
+        covering = [d for d in self._subsets() if dims <= set(d)]
+        return min(covering, key=lambda d: state["rollups"][_rollup_name(d)])
+
+    def query(self, by: list[str] | None = None, where: dict[str, list] | None = None) -> pl.DataFrame:
+        """The measures summed by `by`, over the rows whose `where` columns have one of the given values."""
+        by, where = by or [], where or {}
+        rollup = self.covering_rollup(set(by) | set(where))
+        df = self.read(rollup)
+        for col, values in where.items():
+            df = df.filter(pl.col(col).is_in(values))
+        if tuple(by) != rollup:
+            df = _aggregate(df, tuple(by), self.measures)
+        return df.select(*by, *self.measures)
+
+    def update(self, store: SnapshotStore, version: str | None = None) -> None:
+        """Bring the rollups up to snapshot `version` of `store` (by default its latest).
+
+        Only the rows that changed since the rollups' version are read and added to
+        every rollup. Rollups built from a version the store no longer has are rebuilt
+        from scratch.
+        """
+        version = version or store.latest()
+        if version is None:
+            raise FileNotFoundError(f"No snapshots in {store.root}")  # noqa: TRY003
+        missing = set(self.dimensions) - set(store.key)
+        if missing:
+            raise ValueError(f"Rollup dimensions missing from the snapshot key: {', '.join(sorted(missing))}")  # noqa: TRY003
+        current = self.version
+        if current == version:
+            return
+        if current is None or current not in store.versions():
+            self.build(store.read(version), version)
+            return
+
+        delta = self._delta(store.changes(current, version))
+        print(f"Updating rollups from snapshot {current} to {version}: {delta.height} rows changed")
+        rollups = {}
+        for dims in self._subsets():
+            merged = pl.concat([self.read(dims), _aggregate(delta, dims, self.measures)], how="vertical_relaxed")
+            rollups[dims] = _aggregate(merged, dims, self.measures).filter(pl.col(ROWS) > 0)
+        self._write(rollups, version)
+
+    def _delta(self, changes: pl.DataFrame) -> pl.DataFrame:
+        """The row-level changes from SnapshotStore.changes as amounts to add to the base rollup."""
+        change = pl.col("change")
+        rows = pl.when(change == "added").then(1).when(change == "removed").then(-1).otherwise(0)
+        return changes.select(
+            *self.dimensions,
+            *(
+                (pl.col(f"{m}_new").fill_null(0) - pl.col(f"{m}_old").fill_null(0)).cast(pl.Int64).alias(m)
+                for m in self.measures
+            ),
+            rows.cast(pl.Int64).alias(ROWS),
+        )
@@ -0,0 +1,196 @@
+"""Versioned snapshots of a table, stored as content-addressed Parquet partitions.
+
+Every version is a small JSON manifest listing the table's partitions (one per value of
+the `partition_by` columns), each pointing at a Parquet object named by the hash of its
+content. A partition that did not change between versions is therefore stored once and
+shared by all of them, and comparing two versions only has to read the partitions whose
+hashes differ:
+
+    store = SnapshotStore("data/ma/snapshots", key=["year", "municipality"])
+    version = store.commit(df)
+    store.read(version)
+    store.changes(store.versions()[-2], version)
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+from attrs import define, field
+
+
+def diff_frames(old: pl.DataFrame, new: pl.DataFrame, key: list[str]) -> pl.DataFrame:
+    """Row-level changes from `old` to `new`, matching rows on `key`.
+
+    One row per key that was added, removed or changed, with a `change` column and the
+    `<column>_old` / `<column>_new` values of every other column.
+    """
+    values = [c for c in new.columns if c not in key]
+    joined = old.with_columns(_old=pl.lit(True)).join(
+        new.with_columns(_new=pl.lit(True)), on=key, how="full", coalesce=True, suffix="_new"
+    )
+    changed = pl.any_horizontal(pl.col(v).ne_missing(pl.col(f"{v}_new")) for v in values) if values else pl.lit(False)
+    change = (
+        pl
+        .when(pl.col("_old").is_null())
+        .then(pl.lit("added"))
+        .when(pl.col("_new").is_null())
+        .then(pl.lit("removed"))
+        .when(changed)
+        .then(pl.lit("changed"))
+    )
+    return (
+        joined
+        .with_columns(change=change)
+        .filter(pl.col("change").is_not_null())
+        .select(
+            *key,
+            "change",
+            *(pl.col(v).alias(f"{v}_old") for v in values),
+            *(pl.col(f"{v}_new") for v in values),
+        )
+        .sort(key)
+    )
+
+
+def _digest(df: pl.DataFrame) -> str:
+    return hashlib.sha256(str(df.schema).encode() + df.write_csv().encode()).hexdigest()
+
+
+@define()
+class SnapshotStore:
+    """Versions of one table under `root`: `objects/` holds the partitions, `versions/` the manifests.
+
+    Rows are identified by the `key` columns and sorted by them within each partition,
+    so the same rows always hash to the same object.
+    """
+
+    root: Path = field(converter=Path)
+    key: list[str] = field()
+    partition_by: list[str] = field(factory=lambda: ["year"])
+
+    @property
+    def objects_dir(self) -> Path:
+        return self.root / "objects"
+
+    @property
+    def versions_dir(self) -> Path:
+        return self.root / "versions"
+
+    def _object_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / f"{digest}.parquet"
+
+    def _put(self, df: pl.DataFrame) -> str:
+        """Store `df` unless an identical object is already there; returns its hash."""
+        digest = _digest(df)
+        path = self._object_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            df.write_parquet(tmp)
+            os.replace(tmp, path)
+        return digest
+
+    def manifest(self, version: str) -> dict[str, Any]:
+        path = self.versions_dir / f"{version}.json"
+        if not path.exists():
+            raise KeyError(f"No snapshot version {version} in {self.root}")  # noqa: TRY003
+        manifest: dict[str, Any] = json.loads(path.read_text())
+        return manifest
+
+    def versions(self) -> list[str]:
+        """Every version, oldest first."""
+        manifests = [json.loads(p.read_text()) for p in self.versions_dir.glob("*.json")]
+        return [m["version"] for m in sorted(manifests, key=lambda m: (m["created"], m["version"]))]
+
+    def latest(self) -> str | None:
+        versions = self.versions()
+        return versions[-1] if versions else None
+
+    def _new_version(self) -> str:
+        base = datetime.now().strftime("%Y%m%d")
+        version, n = base, 1
+        while (self.versions_dir / f"{version}.json").exists():
+            n += 1
+            version = f"{base}-{n}"
+        return version
+
+    def commit(self, df: pl.DataFrame, version: str | None = None, message: str = "") -> str:
+        """Store `df` as a new version (by default today's date) and return its name.
+
+        Partitions identical to ones already stored are shared rather than written again.
+        """
+        version = version or self._new_version()
+        path = self.versions_dir / f"{version}.json"
+        if path.exists():
+            raise FileExistsError(f"Snapshot version {version} already exists in {self.root}")  # noqa: TRY003
+        df = df.sort(self.key)
+        partitions = [
+            {"values": dict(zip(self.partition_by, values)), "object": self._put(part), "rows": part.height}
+            for values, part in df.partition_by(self.partition_by, as_dict=True, maintain_order=True).items()
+        ]
+        manifest = {
+            "version": version,
+            "created": datetime.now().isoformat(timespec="microseconds"),
+            "parent": self.latest(),
+            "message": message,
+            "key": self.key,
+            "partition_by": self.partition_by,
+            # An empty object that keeps the column types, even for a version without rows
+            "schema": self._put(df.clear()),
+            "partitions": partitions,
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, indent=1, default=str))
+        os.replace(tmp, path)
+        return version
+
+    def _partitions(self, version: str, where: dict[str, list] | None = None) -> list[dict[str, Any]]:
+        partitions: list[dict[str, Any]] = self.manifest(version)["partitions"]
+        for col, values in (where or {}).items():
+            wanted = {str(v) for v in values}
+            partitions = [p for p in partitions if str(p["values"][col]) in wanted]
+        return partitions
+
+    def scan(self, version: str | None = None, where: dict[str, list] | None = None) -> pl.LazyFrame:
+        """Lazily read `version` (the latest by default).
+
+        `where` maps partition columns to the values to keep; the other partitions'
+        files are not opened at all.
+        """
+        version = version or self.latest()
+        if version is None:
+            raise FileNotFoundError(f"No snapshots in {self.root}")  # noqa: TRY003
+        files = [self._object_path(p["object"]) for p in self._partitions(version, where)]
+        return pl.scan_parquet(files or [self._object_path(self.manifest(version)["schema"])])
+
+    def read(self, version: str | None = None, where: dict[str, list] | None = None) -> pl.DataFrame:
+        return self.scan(version, where).collect()
+
+    def changes(self, old: str | None, new: str) -> pl.DataFrame:
+        """The row-level change log from version `old` to `new` (see diff_frames).
+
+        Partitions the two versions share are skipped without being read; with `old`
+        None, every row of `new` counts as added.
+        """
+        old_objects = {} if old is None else self._objects(old)
+        new_objects = self._objects(new)
+        empty = pl.read_parquet(self._object_path(self.manifest(new)["schema"]))
+        diffs = []
+        for values in sorted(old_objects.keys() | new_objects.keys()):
+            if old_objects.get(values) == new_objects.get(values):
+                continue
+            before, after = (
+                pl.read_parquet(self._object_path(objects[values])) if values in objects else empty
+                for objects in (old_objects, new_objects)
+            )
+            diffs.append(diff_frames(before, after, self.key))
+        return pl.concat(diffs) if diffs else diff_frames(empty, empty, self.key)
+
+    def _objects(self, version: str) -> dict[tuple, str]:
+        return {tuple(str(v) for v in p["values"].values()): p["object"] for p in self.manifest(version)["partitions"]}
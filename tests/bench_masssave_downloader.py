@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmark of the MassSave downloader against the local Power BI stub.
+
+Every scenario downloads a synthetic table through PowerBIStub with a fixed simulated
+network latency and reports the best wall time of a few runs, queries per second and
+the most the download added to the resident set size. Memory is measured on Linux,
+in a separate run in a fresh process with the stub left in this one, so it counts
+everything the downloader allocates (polars' and pyarrow's native buffers included)
+and nothing the stub does. Results are compared with tests/artifacts/benchmark_baseline.json, and the script exits non-zero
+when a scenario's throughput falls more than `--tolerance` below its baseline. How fast
+the stub and the downloader run depends on the machine, so each scenario's speedup over
+the single-query run of its size is compared everywhere, while absolute queries per
+second are only compared on the machine that recorded the baseline:
+
+    python -m tests.bench_masssave_downloader                    # compare with the baseline
+    python -m tests.bench_masssave_downloader --update-baseline  # record a new baseline
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from hp_adoption.masssave import DEFAULT_FILTER_SETS, download_masssave_data
+from tests.powerbi_stub import PowerBIStub, StubTokenProvider, synthetic_table
+
+BASELINE_PATH = Path(__file__).parent / "artifacts" / "benchmark_baseline.json"
+
+FILTER_SET_SIZES = {
+    "small": {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]},
+    "medium": {
+        "Year": DEFAULT_FILTER_SETS["Year"],
+        "End use": ["HVAC", "Hot Water"],
+        "Rate_category": ["Market rate", "Income eligible"],
+    },
+    "full": DEFAULT_FILTER_SETS,
+}
+CONCURRENCY = [1, 8, 32]
+# Each scenario's speedup is taken over the run of its size at this concurrency
+REFERENCE_CONCURRENCY = 1
+LATENCY = 0.02
+JITTER = 0.005
+
+
+def _download(endpoint_url: str, token: str, filter_sets: dict[str, list[str]], max_concurrency: int) -> int:
+    """Download `filter_sets` from the stub at `endpoint_url`, returning the number of rows."""
+    return download_masssave_data(
+        None,
+        filter_sets=filter_sets,
+        max_concurrency=max_concurrency,
+        token_provider=StubTokenProvider(token=token),
+        cache_mode="bypass",
+        endpoint_url=endpoint_url,
+        report=False,
+    ).height
+
+
+def machine() -> dict[str, Any]:
+    """What, besides the code, sets the absolute throughput."""
+    cpu = platform.processor()
+    if sys.platform == "linux":
+        with open("/proc/cpuinfo") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    return {
+        "system": platform.system(),
+        "arch": platform.machine(),
+        "cpu": cpu,
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def _rss() -> int:
+    """This process's resident set size, in bytes (Linux only)."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _download_rss(endpoint_url: str, token: str, filter_sets: dict[str, list[str]], max_concurrency: int) -> int:
+    """Run in a fresh process: the most bytes one download added to its RSS, sampled every millisecond.
+
+    The interpreter's own peak RSS is set by importing polars and pyarrow, well above
+    what a download adds, hence the sampling rather than getrusage.
+    """
+    before = peak = _rss()
+    done = threading.Event()
+
+    def sample() -> None:
+        nonlocal peak
+        while not done.wait(0.001):
+            peak = max(peak, _rss())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        _download(endpoint_url, token, filter_sets, max_concurrency)
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak, _rss()) - before
+
+
+def run_scenario(filter_sets: dict[str, list[str]], max_concurrency: int, measure_memory: bool = False) -> dict:
+    """Download `filter_sets` from a fresh stub and return its timings and counts.
+
+    With `measure_memory` the download runs in a fresh process instead, so only
+    `peak_rss_mib` is meaningful and the timings include starting it.
+    """
+    with PowerBIStub(synthetic_table(filter_sets), latency=LATENCY, jitter=JITTER) as stub:
+        args = (stub.endpoint_url, stub.token, filter_sets, max_concurrency)
+        start = time.perf_counter()
+        peak = None
+        if measure_memory and sys.platform == "linux":
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                peak = pool.submit(_download_rss, *args).result()
+            rows = None
+        else:
+            rows = _download(*args)
+        wall = time.perf_counter() - start
+    return {
+        "queries": stub.queries,
+        "rows": rows,
+        "wall_s": round(wall, 4),
+        "queries_per_s": round(stub.queries / wall, 2),
+        "peak_rss_mib": None if peak is None else round(peak / 2**20, 2),
+    }
+
+
+def run_benchmarks(
+    sizes: list[str] | None = None, concurrency: list[int] | None = None, repeat: int = 3
+) -> dict[str, dict]:
+    """Run every scenario, keeping the fastest of `repeat` timed runs."""
+    results = {}
+    for size in sizes or FILTER_SET_SIZES:
+        for c in concurrency or CONCURRENCY:
+            runs = [run_scenario(FILTER_SET_SIZES[size], c) for _ in range(repeat)]
+            result = min(runs, key=lambda r: r["wall_s"])
+            result["peak_rss_mib"] = run_scenario(FILTER_SET_SIZES[size], c, measure_memory=True)["peak_rss_mib"]
+            results[f"{size}/c{c}"] = result
+    return results
+
+
+def _reference(name: str) -> str:
+    return f"{name.split('/')[0]}/c{REFERENCE_CONCURRENCY}"
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float, same_machine: bool) -> list[str]:
+    """Scenarios whose throughput fell more than `tolerance` below the baseline.
+
+    The speedup over the reference run of the same size is checked for every scenario
+    that has one; the queries per second themselves only with `same_machine`.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]["queries_per_s"]
+        if same_machine and result["queries_per_s"] < expected * (1 - tolerance):
+            regressions.append(f"{name}: {result['queries_per_s']} queries/s, baseline {expected}")
+        reference = _reference(name)
+        if reference == name or reference not in results or reference not in baseline:
+            continue
+        speedup = result["queries_per_s"] / results[reference]["queries_per_s"]
+        expected_speedup = expected / baseline[reference]["queries_per_s"]
+        if speedup < expected_speedup * (1 - tolerance):
+            regressions.append(f"{name}: {speedup:.2f}x {reference}, baseline {expected_speedup:.2f}x")
+    return regressions
+
+
+def print_table(results: dict[str, dict], baseline: dict[str, dict]) -> None:
+    print(f"{'scenario':<12} {'queries':>8} {'rows':>8} {'wall s':>8} {'q/s':>8} {'base q/s':>9} {'peak RSS MiB':>13}")
+    for name, r in results.items():
+        base = baseline.get(name, {}).get("queries_per_s", "")
+        print(
+            f"{name:<12} {r['queries']:>8} {r['rows']:>8} {r['wall_s']:>8} {r['queries_per_s']:>8} {base:>9} {r['peak_rss_mib']:>13}"
+        )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=list(FILTER_SET_SIZES), help="Filter set sizes to run")
+    parser.add_argument("--concurrency", nargs="+", type=int, help="max_concurrency settings to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per scenario; the fastest counts")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed throughput drop vs the baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    recorded = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    same_machine = recorded.get("machine") == machine()
+    baseline = recorded.get("scenarios", {})
+    results = run_benchmarks(args.sizes, args.concurrency, args.repeat)
+    print_table(results, baseline)
+
+    if args.update_baseline:
+        # Scenarios recorded on another machine can't be mixed with these
+        scenarios = (baseline if same_machine else {}) | results
+        BASELINE_PATH.write_text(json.dumps({"machine": machine(), "scenarios": scenarios}, indent=2) + "\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+    if not same_machine:
+        print("The baseline was recorded on another machine: only comparing speedups, not queries/s")
+    regressions = compare(results, baseline, args.tolerance, same_machine)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import pytest
+
+from tests.powerbi_stub import PowerBIStub
+
+
+@pytest.fixture
+def powerbi_stub():
+    """A local querydata service answering from the recorded regression artifact."""
+    with PowerBIStub() as stub:
+        yield stub
@@ -0,0 +1,372 @@
+"""A local stand-in for the Power BI querydata service behind the MassSave dashboard.
+
+PowerBIStub answers querydata POSTs from an in-memory table the way the real service
+does: filters and grouping columns are read out of the semantic query, rows come back
+DSR-compressed (ValueDicts, `R` repeats, `Ø` nulls, integers as "19L") with a DM0
+subtotal, and windows larger than `Window.Count` are paged through restart tokens.
+Latency, jitter, an error rate and a request rate limit can be dialled in, so the downloader can be tested
+and benchmarked end to end without the network:
+
+    with PowerBIStub(table, latency=0.05) as stub:
+        download_masssave_data(
+            None, endpoint_url=stub.endpoint_url, token_provider=stub.token_provider(), cache_mode="bypass"
+        )
+
+It also serves `report_url`, a page that fires one querydata request carrying the
+stub's EmbedToken, so `extract_auth_token(report_url=stub.report_url)` has something to
+intercept.
+"""
+
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import polars as pl
+from attrs import define, field
+
+from hp_adoption.masssave import DEFAULT_FILTER_SETS, FILTERS_TO_SELECTORS, TokenProvider
+
+ARTIFACT_PATH = Path(__file__).parent / "artifacts" / "test_masssave_downloader.csv"
+MEASURES = ["installed_hp_accounts", "installed_hp_locations"]
+
+_STUB_TOKEN_PAYLOAD = base64.urlsafe_b64encode(json.dumps({"exp": 4102444800}).encode()).decode()
+STUB_TOKEN = f"H4sIAAAAAAAEAB2Ut66E.{_STUB_TOKEN_PAYLOAD}"
+
+
+class StubQueryError(ValueError):
+    """A query the stub cannot answer; reported to the client as HTTP 400."""
+
+
+def recorded_table() -> pl.DataFrame:
+    """The regression artifact the live downloader test recorded, as the stub's table."""
+    return pl.read_csv(ARTIFACT_PATH, schema_overrides={"year": pl.String})
+
+
+def synthetic_table(
+    filter_sets: dict[str, list[str]] | None = None,
+    n_municipalities: int = 351,
+    seed: int = 0,
+    empty_combos: float = 0.0,
+) -> pl.DataFrame:
+    """A table over every combination of `filter_sets` and `n_municipalities` towns.
+
+    Roughly one combination in five has no installs in a town and is left out, like the
+    sparse real data, and a share `empty_combos` of the combinations has none anywhere;
+    counts are drawn from `seed` so the table is reproducible.
+    """
+    filter_sets = filter_sets or DEFAULT_FILTER_SETS
+    rng = random.Random(seed)  # noqa: S311
+    empty_rng = random.Random(seed + 1)  # noqa: S311
+    towns = [f"Town {i:03d}" for i in range(n_municipalities)]
+    columns = [col.lower().replace(" ", "_") for col in filter_sets]
+    rows = []
+    for combo in itertools.product(*filter_sets.values()):
+        if empty_combos and empty_rng.random() < empty_combos:
+            continue
+        for town in towns:
+            if rng.random() < 0.2:
+                continue
+            accounts = rng.randint(1, 200)
+            rows.append((*combo, town, accounts, accounts + rng.randint(0, 3)))
+    return pl.DataFrame(rows, schema=[*columns, "municipality", *MEASURES], orient="row")
+
+
+def encode_dsr(rows: list[tuple], n_text: int, total: list[int | None]) -> dict:
+    """DSR-compress `rows` whose first `n_text` values are text and the rest integer measures."""
+    value_dicts = {f"D{i}": sorted({row[i] for row in rows if row[i] is not None}) for i in range(n_text)}
+    indexes = [{value: j for j, value in enumerate(value_dicts[f"D{i}"])} for i in range(n_text)]
+    dm1 = []
+    previous = None
+    for row in rows:
+        item: dict = {"C": []}
+        repeat = null = 0
+        for i, value in enumerate(row):
+            if previous is not None and previous[i] == value:
+                repeat |= 1 << i
+            elif value is None:
+                null |= 1 << i
+            else:
+                item["C"].append(indexes[i][value] if i < n_text else f"{value}L")
+        if repeat:
+            item["R"] = repeat
+        if null:
+            item["Ø"] = null
+        dm1.append(item)
+        previous = row
+    if dm1:
+        dm1[0]["S"] = [
+            {"N": f"G{i}", "T": 1, "DN": f"D{i}"} if i < n_text else {"N": f"M{i - n_text}", "T": 4}
+            for i in range(len(rows[0]))
+        ]
+    dm0 = {"S": [{"N": f"M{i}", "T": 4} for i in range(len(total))]}
+    dm0 |= {f"M{i}": f"{value}L" for i, value in enumerate(total) if value is not None}
+    return {"PH": [{"DM0": [dm0]}, {"DM1": dm1}], "ValueDicts": value_dicts}
+
+
+def _literal(value: dict) -> str:
+    return value["Literal"]["Value"].strip("'")
+
+
+def _condition_filter(condition: dict) -> tuple[str, list[str], bool] | None:
+    """(column, values, negated) of an `In` condition on a MassSave filter dimension, or None."""
+    negated = "Not" in condition
+    if negated:
+        condition = condition["Not"]["Expression"]
+    if "In" not in condition:
+        if "Comparison" in condition:
+            raise StubQueryError("The stub only answers In filters")  # noqa: TRY003
+        return None
+    (expression,) = condition["In"]["Expressions"]
+    column = expression["Column"]["Property"]
+    if column not in FILTERS_TO_SELECTORS:
+        # The fixed conditions every query carries (suppression, heat pump, sector)
+        return None
+    rows = condition["In"]["Values"]
+    if any(len(row) != 1 for row in rows):
+        # Power BI reads each row as a tuple of literals, one for every expression
+        raise StubQueryError(f"An In filter on {column} needs one row per value")  # noqa: TRY003
+    return column, [_literal(value) for (value,) in rows], negated
+
+
+@define
+class StubTokenProvider(TokenProvider):
+    """Hand out a fixed token without scraping or touching the on-disk token cache."""
+
+    token: str = field(default=STUB_TOKEN, kw_only=True)
+
+    async def get_token(self) -> str:
+        return self.token
+
+    async def refresh(self) -> str:
+        return self.token
+
+    def invalidate(self) -> None:
+        pass
+
+
+class PowerBIStub:
+    """Serve querydata requests for `table` from a background thread on localhost."""
+
+    def __init__(
+        self,
+        table: pl.DataFrame | None = None,
+        token: str = STUB_TOKEN,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = HTTPStatus.SERVICE_UNAVAILABLE,
+        max_rps: float | None = None,
+        retry_after: float | None = None,
+        seed: int | None = 0,
+    ):
+        self.table = recorded_table() if table is None else table
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Answer 429 to anything beyond `max_rps` requests in the trailing second
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self._recent: deque[float] = deque()
+        self._rng = random.Random(seed)  # noqa: S311
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.queries = 0
+        self.errors = 0
+        self.throttled = 0
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None, "The stub is not running"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def endpoint_url(self) -> str:
+        return f"{self.url}/explore/querydata?synchronous=true"
+
+    @property
+    def report_url(self) -> str:
+        return f"{self.url}/report"
+
+    def token_provider(self) -> "StubTokenProvider":
+        """A TokenProvider that hands out this stub's token instead of scraping the dashboard."""
+        return StubTokenProvider(token=self.token)
+
+    def start(self) -> "PowerBIStub":
+        handler = type("_Handler", (_StubHandler,), {"stub": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "PowerBIStub":
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            return self.error_rate > 0 and self._rng.random() < self.error_rate
+
+    def _over_rate(self) -> bool:
+        if self.max_rps is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_rps:
+                self.throttled += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    def _count(self, queries: int, error: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.queries += queries
+            self.errors += error
+
+    def answer(self, payload: dict) -> dict:
+        """The querydata response for a parsed request body."""
+        return {
+            "jobIds": [f"job-{i}" for i in range(len(payload["queries"]))],
+            "results": [
+                {"jobId": f"job-{i}", "result": self._answer_query(q)} for i, q in enumerate(payload["queries"])
+            ],
+        }
+
+    def _answer_query(self, entry: dict) -> dict:
+        started = datetime.now(timezone.utc)
+        (command,) = entry["Query"]["Commands"]
+        shape = command["SemanticQueryDataShapeCommand"]
+        query = shape["Query"]
+        window = shape["Binding"]["DataReduction"]["Primary"]["Window"]
+
+        # Grouping columns, then (unless the query only wants totals) the city, then the measures
+        columns = [s["Column"]["Property"] for s in query["Select"] if "Column" in s]
+        group_by = [col.lower().replace(" ", "_") for col in columns if col != "City"]
+
+        df = self.table
+        for where in query["Where"]:
+            parsed = _condition_filter(where["Condition"])
+            if parsed is None:
+                continue
+            column, values, negated = parsed
+            col = column.lower().replace(" ", "_")
+            if col not in df.columns:
+                raise StubQueryError(f"The stub table has no {column} column")  # noqa: TRY003
+            keep = df[col].cast(pl.String).is_in(values)
+            df = df.filter(~keep if negated else keep)
+
+        keys = [*group_by, *(["municipality"] if "City" in columns else [])]
+        df = df.with_columns(pl.col(group_by).cast(pl.String)).group_by(keys).agg(pl.col(MEASURES).sum()).sort(keys)
+        total = [df[m].sum() if not df.is_empty() else None for m in MEASURES]
+
+        # Restart tokens are opaque to the client; the stub's are just the next row offset
+        start = int(window["RestartTokens"][0][0]) if "RestartTokens" in window else 0
+        end = start + window["Count"]
+        rows = df.slice(start, window["Count"]).rows()
+        ds = encode_dsr(rows, len(keys), total)
+        if end < df.height:
+            ds |= {"RT": [[str(end)]], "IC": False}
+        else:
+            ds["IC"] = True
+        # The execution events a query with ExecutionMetricsKind 1 gets back
+        event = {
+            "Id": entry.get("QueryId", ""),
+            "Name": "Execute Semantic Query",
+            "Component": "DSE",
+            "Start": started.isoformat(),
+            "End": datetime.now(timezone.utc).isoformat(),
+            "Metrics": {"RowCount": len(rows)},
+        }
+        return {"data": {"dsr": {"DS": [ds]}, "metrics": {"Version": "1.0.0", "Events": [event]}}}
+
+
+_REPORT_PAGE = """<!doctype html>
+<html><body><script>
+fetch("/explore/querydata?synchronous=true", {
+  method: "POST",
+  headers: {"authorization": "EmbedToken %s", "content-type": "application/json"},
+  body: JSON.stringify({version: "1.0.0", queries: [], cancelQueries: []}),
+});
+</script></body></html>
+"""
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    stub: PowerBIStub
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoint
+    # The headers and the body go out in separate writes; with Nagle on, the body waits
+    # for the client's delayed ACK of the headers, some 40 ms on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json; charset=utf-8") -> None:
+        self.send_response(status)
+        if status >= 400 and self.stub.retry_after is not None:
+            self.send_header("Retry-After", str(self.stub.retry_after))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != "/report":
+            self._send(HTTPStatus.NOT_FOUND, b"")
+            return
+        self._send(HTTPStatus.OK, (_REPORT_PAGE % self.stub.token).encode(), "text/html; charset=utf-8")
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        stub = self.stub
+        time.sleep(stub._delay())
+
+        if self.headers.get("authorization") != f"EmbedToken {stub.token}":
+            stub._count(0, error=True)
+            self._send(HTTPStatus.UNAUTHORIZED, b'{"error": "TokenExpired"}')
+            return
+        payload = json.loads(body)
+        if stub._over_rate():
+            self._send(HTTPStatus.TOO_MANY_REQUESTS, b'{"error": "TooManyRequests"}')
+            return
+        if stub._should_fail():
+            stub._count(0, error=True)
+            self._send(stub.error_status, b'{"error": "ServiceUnavailable"}')
+            return
+        try:
+            response = stub.answer(payload)
+        except (StubQueryError, KeyError, ValueError) as e:
+            stub._count(0, error=True)
+            self._send(HTTPStatus.BAD_REQUEST, json.dumps({"error": str(e)}).encode())
+            return
+        stub._count(len(payload["queries"]), error=False)
+        # The real service prefixes its JSON with a byte order mark
+        self._send(HTTPStatus.OK, json.dumps(response).encode("utf-8-sig"))
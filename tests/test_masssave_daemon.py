@@ -0,0 +1,157 @@
+import asyncio
+import json
+import threading
+import time
+from pathlib import Path
+
+import polars as pl
+import pytest
+from attrs import define, field
+
+from hp_adoption.masssave import RefreshDaemon, ResponseCache, send_command
+from hp_adoption.masssave.daemon import main
+from tests.powerbi_stub import StubTokenProvider
+from tests.test_masssave_downloader import _make_token
+
+FILTER_SETS = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+
+
+def _start(daemon: RefreshDaemon) -> threading.Thread:
+    thread = threading.Thread(target=asyncio.run, args=(daemon.serve(),), daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            send_command({"command": "health"}, daemon.socket_path)
+        except OSError:
+            assert time.monotonic() < deadline, "The daemon didn't start listening"
+            time.sleep(0.01)
+        else:
+            return thread
+
+
+def _stop(daemon: RefreshDaemon, thread: threading.Thread) -> None:
+    assert send_command({"command": "stop"}, daemon.socket_path)["ok"]
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not daemon.socket_path.exists()
+
+
+def test_refresh_daemon_runs_jobs(powerbi_stub, tmp_path):
+    sock = tmp_path / "daemon.sock"
+    sock.write_text("")  # left behind by a daemon that was killed
+    daemon = RefreshDaemon(
+        sock,
+        token_provider=powerbi_stub.token_provider(),
+        download_options={"endpoint_url": powerbi_stub.endpoint_url, "cache_mode": "bypass"},
+    )
+    thread = _start(daemon)
+    with pytest.raises(FileExistsError):
+        RefreshDaemon(sock)._claim_socket()
+
+    reply = send_command(
+        {
+            "command": "refresh",
+            "jobs": {
+                "residential": {"filter_sets": FILTER_SETS, "outfile": str(tmp_path / "residential.csv")},
+                "commercial": {"filter_sets": FILTER_SETS, "sector": "Commercial", "mode": "cube"},
+            },
+            "wait": True,
+        },
+        sock,
+    )
+    assert reply["ok"], reply
+    assert reply["rows"] == {"residential": 1030, "commercial": 1030}
+    assert reply["pages"] > 0
+    expected = pl.read_csv("tests/artifacts/test_masssave_downloader.csv")
+    assert expected.equals(pl.read_csv(tmp_path / "residential.csv"))
+
+    failed = send_command({"command": "refresh", "jobs": {"bad": {"mode": "rollup"}}, "wait": True}, sock)
+    assert not failed["ok"]
+    assert "Invalid mode" in failed["error"]
+    assert "unexpected keyword" in send_command({"command": "refresh", "jobs": {"x": {"colour": 1}}}, sock)["error"]
+    assert not send_command({"command": "reboot"}, sock)["ok"]
+
+    health = send_command({"command": "health"}, sock)
+    assert health["status"] == "ok"
+    assert health["token_expires_in_s"] > 0
+    assert health["queued"] == 0
+    assert health["running"] is None
+    assert health["last_run"]["error"] == failed["error"]
+    assert health["failed_runs"] == 1
+    assert [run["jobs"] for run in send_command({"command": "stats"}, sock)["runs"]] == [
+        ["residential", "commercial"],
+        ["bad"],
+    ]
+    _stop(daemon, thread)
+
+
+def test_refresh_daemon_jobs_skip_the_response_cache(powerbi_stub, tmp_path):
+    with pytest.raises(ValueError, match="Invalid cache_mode"):
+        RefreshDaemon(token_provider=powerbi_stub.token_provider(), download_options={"cache_mode": "stale"})
+
+    cache = ResponseCache(tmp_path / "cache")
+    refresher = RefreshDaemon(
+        tmp_path / "daemon.sock",
+        token_provider=powerbi_stub.token_provider(),
+        download_options={"endpoint_url": powerbi_stub.endpoint_url, "cache": cache},
+    )
+    thread = _start(refresher)
+    runs = [
+        send_command(
+            {"command": "refresh", "jobs": {"t": {"filter_sets": FILTER_SETS}}, "wait": True}, refresher.socket_path
+        )
+        for _ in range(2)
+    ]
+    assert [run["cached_pages"] for run in runs] == [0, 0]
+    assert powerbi_stub.queries == sum(run["pages"] for run in runs)
+    _stop(refresher, thread)
+
+
+def test_refresh_cli_resolves_paths(monkeypatch, tmp_path):
+    sent = []
+    monkeypatch.setattr(
+        "hp_adoption.masssave.daemon.send_command", lambda message, socket_path: sent.append(message) or {"ok": True}
+    )
+    monkeypatch.chdir(tmp_path)
+
+    main(["refresh", json.dumps({"outfile": "out.csv", "parquet_dir": "~/masssave", "run_dir": None})])
+    main(["refresh"])
+    job = sent[0]["jobs"]["masssave"]
+    assert job == {
+        "outfile": str(tmp_path / "out.csv"),
+        "parquet_dir": str(Path.home() / "masssave"),
+        "run_dir": None,
+    }
+    assert Path(sent[1]["jobs"]["masssave"]["outfile"]).parent == tmp_path
+
+
+@define
+class _ShortLivedTokenProvider(StubTokenProvider):
+    """Every token goes stale `lifetime` seconds after it is handed out."""
+
+    lifetime: float = field(default=0.0, kw_only=True)
+    refreshes: int = field(default=0, kw_only=True)
+
+    async def get_token(self) -> str:
+        return _make_token(time.time() + self.safety_margin + self.lifetime)
+
+    async def refresh(self) -> str:
+        self.refreshes += 1
+        return await self.get_token()
+
+
+def test_refresh_daemon_refreshes_token_ahead_of_expiry(tmp_path):
+    # The first token has 10 minutes left, and the daemon scrapes with 10 minutes to spare
+    provider = _ShortLivedTokenProvider(lifetime=600)
+    daemon = RefreshDaemon(tmp_path / "daemon.sock", token_provider=provider, prerefresh_lead=600)
+    thread = _start(daemon)
+
+    deadline = time.monotonic() + 5
+    while provider.refreshes == 0:
+        assert time.monotonic() < deadline, "The token was never refreshed"
+        time.sleep(0.05)
+    health = send_command({"command": "health"}, daemon.socket_path)
+    assert health["token_refreshes"] >= 1
+    assert health["browser_running"] is False
+    _stop(daemon, thread)
@@ -1,10 +1,122 @@
 #!/usr/bin/env python3
 
+import asyncio
+import base64
+import json
+import random
+import time
 from pathlib import Path
 
 import polars as pl
+import pyarrow as pa
+import pytest
+from attrs import define, evolve, field
 
-from data.ma.masssave_downloader import download_masssave_data
+from hp_adoption.masssave import (
+    AdaptiveRateLimiter,
+    DownloadJob,
+    MassSaveBatch,
+    MassSaveFilter,
+    MassSaveQuery,
+    MassSaveQueryError,
+    MetricsRecorder,
+    ResponseCache,
+    RetryPolicy,
+    RunCheckpoint,
+    TokenProvider,
+    apply_schema,
+    browser,
+    download_many,
+    download_masssave_data,
+    download_masssave_data_async,
+    electrification_spec,
+    masssave_schema,
+    payload_key,
+    refresh_masssave_snapshot,
+    scan_masssave,
+    to_arrow,
+    token_expiry,
+)
+from hp_adoption.masssave import __main__ as masssave_main
+from hp_adoption.masssave.download import _probe_query, _response_cache
+from hp_adoption.masssave.spec import in_condition
+from hp_adoption.snapshots import SnapshotStore
+from tests.powerbi_stub import PowerBIStub, StubTokenProvider, recorded_table, synthetic_table
+
+TOKEN = "token"  # noqa: S105
+OTHER_TOKEN = "other-token"  # noqa: S105
+
+# Payload segment of the sample EmbedToken in masssave_explore.qmd
+SAMPLE_TOKEN_PAYLOAD = "eyJjbHVzdGVyVXJsIjoiaHR0cHM6Ly9XQUJJLU5PUlRILUVVUk9QRS1FLVBSSU1BUlktcmVkaXJlY3QuYW5hbHlzaXMud2luZG93cy5uZXQiLCJleHAiOjE3NTA5NTY0ODksInByaXZhdGVMaW5rc0VuYWJsZWQiOnRydWUsImFsbG93QWNjZXNzT3ZlclB1YmxpY0ludGVybmV0Ijp0cnVlfQ=="  # noqa: S105
+
+
+def _compressed_dsr_response(rows: list[list]) -> dict:
+    """Build a querydata response the way Power BI compresses it.
+
+    String columns are dictionary-encoded through ValueDicts, a value equal to the one
+    above it is left out and flagged in the row's `R` bitmask, and None is flagged in `Ø`.
+    """
+    n = len(rows[0]) if rows else 0
+    string_cols = [i for i in range(n) if isinstance(rows[0][i], str)]
+    value_dicts = {f"D{j}": sorted({row[i] for row in rows}) for j, i in enumerate(string_cols)}
+    dm1 = []
+    previous = None
+    for row in rows:
+        item = {"C": []}
+        repeat = null = 0
+        for i, value in enumerate(row):
+            if previous is not None and previous[i] == value:
+                repeat |= 1 << i
+            elif value is None:
+                null |= 1 << i
+            elif i in string_cols:
+                item["C"].append(value_dicts[f"D{string_cols.index(i)}"].index(value))
+            else:
+                item["C"].append(f"{value}L")
+        if repeat:
+            item["R"] = repeat
+        if null:
+            item["Ø"] = null
+        dm1.append(item)
+        previous = row
+    if dm1:
+        dm1[0]["S"] = [
+            {"N": f"G{i}", "T": 1, "DN": f"D{string_cols.index(i)}"} if i in string_cols else {"N": f"M{i}", "T": 4}
+            for i in range(n)
+        ]
+    ds = {"PH": [{"DM0": [{}]}, {"DM1": dm1}], "IC": True, "ValueDicts": value_dicts}
+    return {"results": [{"result": {"data": {"dsr": {"DS": [ds]}}}}]}
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, data: dict):
+        self.status_code = status_code
+        self.content = json.dumps(data).encode("utf-8-sig")
+        self.text = json.dumps(data)
+
+
+class _FakeSession:
+    """Stands in for requests.Session, answering every POST with `data` and counting calls."""
+
+    def __init__(self, data: dict, status_code: int = 200):
+        self.data = data
+        self.status_code = status_code
+        self.posts = []
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        self.posts.append(json.loads(data))
+        return _FakeResponse(self.status_code, self.data)
+
+
+def _make_token(exp: float) -> str:
+    payload = base64.b64encode(json.dumps({"exp": int(exp)}).encode()).decode()
+    return f"H4sIAAAAAAAEAB2Ut66E.{payload}"
+
+
+def _dsr_response(rows: list[list]) -> dict:
+    """Build a minimal querydata response with `rows` of [municipality, accounts, locations]."""
+    dm1 = [{"C": [city, f"{accounts}L", f"{locations}L"]} for city, accounts, locations in rows]
+    return {"results": [{"result": {"data": {"dsr": {"DS": [{"PH": [{"DM0": [{}]}, {"DM1": dm1}]}]}}}}]}
 
 
 def test_masssave_downloader():
@@ -50,3 +162,697 @@ def test_masssave_downloader():
         assert expected_data.equals(data), "Data content mismatch"
 
         print("Regression test passed - data matches expected artifact")
+
+
+def test_masssave_downloader_async_preserves_order(monkeypatch):
+    """Concurrent queries come back in product order, whatever order they finish in."""
+
+    def fake_run_query_dict(self, token, *args):
+        time.sleep(random.uniform(0, 0.02))  # noqa: S311
+        year, end_use = (f.values[0] for f in self.filters)
+        if (year, end_use) == ("2020", "Hot Water"):
+            return _dsr_response([])
+        return _dsr_response([["Acton", int(year), 1], ["Abington", int(year), 2]])
+
+    monkeypatch.setattr(MassSaveQuery, "run_query_dict", fake_run_query_dict)
+
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    data = asyncio.run(
+        download_masssave_data_async(outfile=None, filter_sets=filter_sets, max_concurrency=3, auth_token=TOKEN)
+    )
+
+    assert data.columns == ["year", "end_use", "municipality", "installed_hp_accounts", "installed_hp_locations"]
+    assert data.select("year", "end_use").unique(maintain_order=True).rows() == [
+        ("2019", "HVAC"),
+        ("2019", "Hot Water"),
+        ("2020", "HVAC"),
+    ]
+    assert data.filter(pl.col("year") == "2019")["installed_hp_accounts"].to_list() == [2019] * 4
+
+
+def test_token_expiry():
+    assert token_expiry(f"H4sIAAAAAAAEAB2Ut66E.{SAMPLE_TOKEN_PAYLOAD}") == 1750956489
+
+
+def test_token_provider_reuses_fresh_token_and_rescrapes_stale(tmp_path, monkeypatch):
+    scraped = []
+
+    async def fake_extract_auth_token():
+        scraped.append(_make_token(time.time() + 3600))
+        return scraped[-1]
+
+    monkeypatch.setattr(browser, "extract_auth_token", fake_extract_auth_token)
+    path = tmp_path / "token.json"
+
+    # Nothing cached yet: scrape and persist
+    first = asyncio.run(TokenProvider(path=path).get_token())
+    assert scraped == [first]
+
+    # A new provider (i.e. a new run) picks the token up from disk
+    assert asyncio.run(TokenProvider(path=path).get_token()) == first
+    assert len(scraped) == 1
+
+    # Inside the safety margin the cached token is no longer handed out
+    path.write_text(json.dumps({"token": _make_token(time.time() + 60)}))
+    assert asyncio.run(TokenProvider(path=path, safety_margin=300).get_token()) == scraped[-1]
+    assert len(scraped) == 2
+
+
+def test_response_cache(tmp_path, monkeypatch):
+    session = _FakeSession(_dsr_response([["Acton", 3, 3]]))
+    cache = ResponseCache(path=tmp_path)
+    msq = MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2019"])])
+
+    first = msq.run_query(token=TOKEN, session=session, cache=cache)
+    # Same payload under a different token is answered from disk
+    again = MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2019"])]).run_query(
+        token=OTHER_TOKEN, session=session, cache=cache
+    )
+    assert len(session.posts) == 1
+    assert first.equals(again)
+
+    # A different payload is a miss, and refresh always goes to the network
+    MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2020"])]).run_query(TOKEN, session, cache)
+    msq.run_query(TOKEN, session, cache, refresh=True)
+    assert len(session.posts) == 3
+
+    # So is the same payload sent to another endpoint
+    elsewhere = "http://127.0.0.1:1/public/reports/querydata"
+    MassSaveQuery(filters=msq.filters, endpoint_url=elsewhere).run_query(TOKEN, session, cache)
+    MassSaveBatch([MassSaveQuery(filters=msq.filters, endpoint_url=elsewhere)]).run_queries(TOKEN, session, cache)
+    assert len(session.posts) == 4
+    assert payload_key(msq.payload) != payload_key(msq.payload, elsewhere)
+
+    # Expired entries are ignored
+    msq.run_query(TOKEN, session, ResponseCache(path=tmp_path, ttl=-1))
+    assert len(session.posts) == 5
+
+    # Eviction keeps the cache under its size bound, and only scans the cache when it has to
+    small = ResponseCache(path=tmp_path, max_bytes=1)
+    msq.run_query(TOKEN, session, small, refresh=True)
+    assert list(tmp_path.glob("*/*.json")) == []
+    bounded = ResponseCache(path=tmp_path, max_bytes=10_000)
+    scans = []
+    entries = ResponseCache._entries
+    monkeypatch.setattr(ResponseCache, "_entries", lambda self: scans.append(1) or entries(self))
+    for i in range(200):
+        bounded.put(f"{i:064x}", b"x" * 100)
+    assert len(scans) < 20
+    assert sum(f.stat().st_size for f in tmp_path.glob("*/*.json")) <= 10_000
+
+    # An error answered with a 200 raises and is not cached as a response
+    failing = _FakeSession({"results": [{"result": {"error": {"code": "QueryExecutionFailed"}}}]})
+    errored = MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2018"])])
+    fresh = ResponseCache(path=tmp_path / "fresh")
+    for _ in range(2):
+        with pytest.raises(MassSaveQueryError, match="QueryExecutionFailed"):
+            errored.run_query(TOKEN, failing, fresh)
+    assert len(failing.posts) == 2
+    assert list(fresh.path.glob("*/*.json")) == []
+
+    # Downloads only go through a cache when one is asked for
+    assert _response_cache(None, None) is None
+    assert _response_cache(cache, None) is cache
+    assert _response_cache(None, "bypass") is None
+
+
+def test_masssave_downloader_resume(tmp_path, monkeypatch):
+    """A failed combination is checkpointed as failed, and resume only re-runs what is outstanding."""
+    calls = []
+    flaky = {("2020", "HVAC")}
+
+    def fake_run_query_dict(self, token, *args):
+        combo = tuple(f.values[0] for f in self.filters)
+        calls.append(combo)
+        if combo in flaky:
+            raise MassSaveQueryError("HTTP 503: Service Unavailable")  # noqa: TRY003
+        if combo == ("2020", "Hot Water"):
+            return _dsr_response([])
+        return _dsr_response([["Acton", 1, 1]])
+
+    monkeypatch.setattr(MassSaveQuery, "run_query_dict", fake_run_query_dict)
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    run = {"outfile": None, "filter_sets": filter_sets, "auth_token": "token", "run_dir": tmp_path / "run"}
+
+    with pytest.raises(MassSaveQueryError, match="1 of 4 combinations failed"):
+        asyncio.run(download_masssave_data_async(**run))
+    assert len(calls) == 4
+
+    # Without resume an existing run directory is never silently reused
+    with pytest.raises(FileExistsError):
+        asyncio.run(download_masssave_data_async(**run))
+
+    flaky.clear()
+    data = asyncio.run(download_masssave_data_async(**run, resume=True))
+    assert calls[4:] == [("2020", "HVAC")]
+    assert data.select("year", "end_use").rows() == [("2019", "HVAC"), ("2019", "Hot Water"), ("2020", "HVAC")]
+
+
+def test_masssave_query_group_by():
+    msq = MassSaveQuery(
+        filters=[MassSaveFilter(column="Year", values=["2019"]), MassSaveFilter(column="End use", values=["HVAC"])],
+        group_by=["End use", "Rate_category"],
+    )
+    command = msq._create_query()["queries"][0]["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"]
+    query = command["Query"]
+    assert [s["Name"] for s in query["Select"]][:3] == [
+        "Dim_End_use.End use",
+        "Dim_Rate_Category.Rate_category",
+        "Dim_City.City",
+    ]
+    # Grouping on a filtered dimension reuses the filter's source
+    assert query["Select"][0]["Column"]["Expression"]["SourceRef"]["Source"] == "d1"
+    assert {"Name": "g1", "Entity": "Dim_Rate_Category", "Type": 0} in query["From"]
+    assert command["Binding"]["Primary"]["Groupings"][0]["Projections"] == [0, 1, 2, 3, 4]
+    assert msq.columns() == [
+        "end_use",
+        "rate_category",
+        "municipality",
+        "installed_hp_accounts",
+        "installed_hp_locations",
+    ]
+
+
+def test_masssave_filter_in_has_one_row_per_value():
+    cond = MassSaveFilter(column="End use", values=["HVAC", "Hot Water"]).to_dict("d1")["Condition"]["In"]
+    assert len(cond["Expressions"]) == 1
+    assert cond["Values"] == [[{"Literal": {"Value": "'HVAC'"}}], [{"Literal": {"Value": "'Hot Water'"}}]]
+
+    inverted = MassSaveFilter(column="Year", values=["2019"], invert=True).to_dict("d0")["Condition"]
+    assert inverted["Not"]["In"]["Values"] == [[{"Literal": {"Value": "'2019'"}}]]
+
+
+# Year, End use, municipality, accounts, locations
+TABLE = [
+    ["2019", "HVAC", "Acton", 3, 3],
+    ["2019", "HVAC", "Adams", 3, 4],
+    ["2019", "Hot Water", "Acton", 1, 1],
+    ["2019", "Hot Water", "Adams", 1, None],
+    ["2020", "HVAC", "Acton", 5, 5],
+]
+
+
+def _fake_table_query(self, token, *args):
+    """run_query_dict stand-in answering Year x End use queries (plain or grouped) from TABLE."""
+    wanted = {f.column: f.values for f in self.filters}
+    rows = [r for r in TABLE if r[0] in wanted["Year"] and r[1] in wanted["End use"]]
+    if self.group_by:
+        return _compressed_dsr_response([r[1:] for r in rows])
+    return _dsr_response([r[2:] for r in rows if r[4] is not None])
+
+
+def test_masssave_downloader_cube_matches_combos(monkeypatch):
+    monkeypatch.setattr(MassSaveQuery, "run_query_dict", _fake_table_query)
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+
+    cube = asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN, mode="cube"))
+    assert cube.rows() == [
+        ("2019", "HVAC", "Acton", 3, 3),
+        ("2019", "HVAC", "Adams", 3, 4),
+        ("2019", "Hot Water", "Acton", 1, 1),
+        ("2019", "Hot Water", "Adams", 1, None),
+        ("2020", "HVAC", "Acton", 5, 5),
+    ]
+    combos = asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN))
+    assert cube.columns == combos.columns
+    assert cube.drop_nulls().equals(combos)
+
+
+class _PagingSession:
+    """Serves `rows` in pages of the requested window size, following restart tokens."""
+
+    def __init__(self, rows: list[list]):
+        self.rows = rows
+        self.windows = []
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        command = json.loads(data)["queries"][0]["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"]
+        window = command["Binding"]["DataReduction"]["Primary"]["Window"]
+        self.windows.append(window)
+        start = window["RestartTokens"][0][0] if "RestartTokens" in window else 0
+        end = start + window["Count"]
+        data = _compressed_dsr_response(self.rows[start:end])
+        if end < len(self.rows):
+            ds = data["results"][0]["result"]["data"]["dsr"]["DS"][0]
+            ds["IC"] = False
+            ds["RT"] = [[end]]
+        return _FakeResponse(200, data)
+
+
+def test_masssave_query_follows_restart_tokens():
+    rows = [["HVAC", f"Town {i:03}", i, i] for i in range(7)]
+    session = _PagingSession(rows)
+    msq = MassSaveQuery(
+        filters=[MassSaveFilter(column="End use", values=["HVAC"])], group_by=["End use"], window_count=3
+    )
+
+    batches = list(msq.iter_batches(TOKEN, session))
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert session.windows == [{"Count": 3}, {"Count": 3, "RestartTokens": [[3]]}, {"Count": 3, "RestartTokens": [[6]]}]
+
+    data = asyncio.run(msq.run_query_async(TOKEN, session))
+    assert data["municipality"].to_list() == [r[1] for r in rows]
+    assert data["installed_hp_accounts"].to_list() == list(range(7))
+
+
+def test_json_to_df_decodes_compressed_rows():
+    rows = [["Abington", 19, 19], ["Acton", 19, 20], ["Adams", None, 4], ["Yarmouth", 4, 4], ["Zion", 4, 4]]
+    data = _compressed_dsr_response(rows)
+    dm1 = data["results"][0]["result"]["data"]["dsr"]["DS"][0]["PH"][1]["DM1"]
+    # These are exactly the rows the old decoder threw away for having fewer than three cells
+    assert [len(item["C"]) for item in dm1] == [3, 2, 2, 2, 1]
+    data["results"][0]["result"]["data"]["dsr"]["DS"][0]["PH"][0]["DM0"] = [{"M0": "46L", "M1": 51}]
+
+    df = MassSaveQuery._json_to_df(data)
+    assert df.schema == {
+        "municipality": pl.String,
+        "installed_hp_accounts": pl.Int64,
+        "installed_hp_locations": pl.Int64,
+    }
+    assert df.rows() == [tuple(r) for r in rows]
+    assert MassSaveQuery._json_to_total(data) == {"installed_hp_accounts": 46, "installed_hp_locations": 51}
+
+    # Responses arrive with a BOM; they are parsed from the raw bytes
+    assert _FakeResponse(200, data).content.startswith(b"\xef\xbb\xbf")
+    assert MassSaveQuery(filters=[]).run_query(TOKEN, _FakeSession(data)).equals(df)
+
+
+def test_masssave_downloader_parquet_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(MassSaveQuery, "run_query_dict", _fake_table_query)
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    root = tmp_path / "masssave"
+
+    in_memory = asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN, mode="cube"))
+    data = asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN, mode="cube", parquet_dir=root))
+    assert data.equals(in_memory)
+    assert sorted(p.relative_to(root).as_posix() for p in root.rglob("*.parquet")) == [
+        "year=2019/end_use=HVAC/data.parquet",
+        "year=2019/end_use=Hot%20Water/data.parquet",
+        "year=2020/end_use=HVAC/data.parquet",
+    ]
+
+    lf = scan_masssave(root)
+    assert lf.collect_schema()["year"] == pl.Int16
+    hot_water = lf.filter(pl.col("end_use") == "Hot Water")
+    assert "year=2020" not in hot_water.explain()
+    assert hot_water.collect()["municipality"].to_list() == ["Acton", "Adams"]
+
+    # No combination has installs: nothing is written, and the table is empty but fully shaped
+    empty_sets = {"Year": ["2021"], "End use": ["HVAC"]}
+    empty_root = tmp_path / "empty"
+    empty = asyncio.run(download_masssave_data_async(None, empty_sets, auth_token=TOKEN, parquet_dir=empty_root))
+    assert not list(empty_root.rglob("*.parquet"))
+    assert empty.is_empty()
+    assert empty.schema == in_memory.schema
+    assert empty.equals(asyncio.run(download_masssave_data_async(None, empty_sets, auth_token=TOKEN)))
+
+
+@pytest.mark.parametrize("mode", ["combos", "cube"])
+def test_masssave_downloader_parquet_rerun(tmp_path, monkeypatch, mode):
+    """Re-running into a populated directory drops the partitions of combinations that are now empty."""
+    monkeypatch.setattr(MassSaveQuery, "run_query_dict", _fake_table_query)
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    root = tmp_path / "masssave"
+    asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN, mode=mode, parquet_dir=root))
+    assert len(list(root.rglob("*.parquet"))) == 3
+
+    # The 2019 Hot Water and 2020 rows have since gone: one leaf of a non-empty query, and a whole query
+    monkeypatch.setitem(globals(), "TABLE", TABLE[:2])
+    data = asyncio.run(download_masssave_data_async(None, filter_sets, auth_token=TOKEN, mode=mode, parquet_dir=root))
+    assert data.rows() == [("2019", "HVAC", "Acton", 3, 3), ("2019", "HVAC", "Adams", 3, 4)]
+    assert [p.relative_to(root).as_posix() for p in root.rglob("*.parquet")] == ["year=2019/end_use=HVAC/data.parquet"]
+
+
+class _YearSession:
+    """Answers each entry of a (possibly batched) request with one town whose counts are its Year filter."""
+
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        entries = json.loads(data)["queries"]
+        self.posts.append(len(entries))
+        results = []
+        for entry in entries:
+            where = entry["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"]["Query"]["Where"]
+            year = int(where[-1]["Condition"]["In"]["Values"][0][0]["Literal"]["Value"].strip("'"))
+            results.append(_compressed_dsr_response([[f"Town {year}", year, year]])["results"][0])
+        return _FakeResponse(200, {"jobIds": [], "results": results})
+
+
+def test_masssave_batch(tmp_path):
+    def year_query(year):
+        return MassSaveQuery(filters=[MassSaveFilter(column="Year", values=[year])])
+
+    session = _YearSession()
+    cache = ResponseCache(path=tmp_path)
+
+    first = MassSaveBatch([year_query("2019"), year_query("2020")]).run_queries(TOKEN, session, cache)
+    assert session.posts == [2]
+    assert [df.rows() for df in first] == [[("Town 2019", 2019, 2019)], [("Town 2020", 2020, 2020)]]
+
+    # Cached entries are left out of the next batch, and batch and single queries share the cache
+    second = asyncio.run(
+        MassSaveBatch([year_query(y) for y in ("2019", "2020", "2021")]).run_queries_async(TOKEN, session, cache)
+    )
+    assert session.posts == [2, 1]
+    assert second[2].rows() == [("Town 2021", 2021, 2021)]
+    assert year_query("2021").run_query(TOKEN, session, cache).equals(second[2])
+    assert session.posts == [2, 1]
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"mode": "cube"}, {"batch_size": 3, "max_concurrency": 2}],
+    ids=["combos", "cube", "batched"],
+)
+def test_masssave_downloader_against_stub(powerbi_stub, options):
+    """The live regression test, replayed against the local querydata stand-in."""
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    data = download_masssave_data(
+        outfile=None,
+        filter_sets=filter_sets,
+        token_provider=powerbi_stub.token_provider(),
+        cache_mode="bypass",
+        endpoint_url=powerbi_stub.endpoint_url,
+        **options,
+    ).cast(pl.Utf8)
+
+    expected = pl.read_csv("tests/artifacts/test_masssave_downloader.csv").cast(pl.Utf8)
+    assert expected.equals(data)
+    assert powerbi_stub.errors == 0
+
+
+def test_masssave_downloader_window_count(powerbi_stub, monkeypatch):
+    """Cube queries page through their rows; a bigger window_count takes fewer round trips for the same table."""
+    options = {
+        "outfile": None,
+        "filter_sets": {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]},
+        "token_provider": powerbi_stub.token_provider(),
+        "endpoint_url": powerbi_stub.endpoint_url,
+        "mode": "cube",
+    }
+    small = download_masssave_data(**options, window_count=2)
+    small_requests = powerbi_stub.requests
+    large = download_masssave_data(**options, window_count=10_000)
+
+    assert large.equals(small)
+    assert powerbi_stub.requests - small_requests == 2
+    assert small_requests > 2 * (powerbi_stub.requests - small_requests)
+    with pytest.raises(ValueError, match="window_count"):
+        download_masssave_data(**options, window_count=0)
+
+    # The command line takes it too
+    calls = []
+    monkeypatch.setattr(masssave_main, "download_masssave_data", lambda **kwargs: calls.append(kwargs))
+    masssave_main.main(["--mode", "cube", "--window-count", "5000"])
+    assert calls[0]["mode"] == "cube"
+    assert calls[0]["window_count"] == 5000
+
+
+def test_visual_spec_sector_and_model():
+    commercial = electrification_spec("Commercial")
+    msq = MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2019"])], spec=commercial)
+    entry = msq._create_query()["queries"][0]
+    where = entry["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"]["Query"]["Where"]
+    assert in_condition("s4", "Sector", "'Commercial'") in where
+    assert in_condition("s4", "Sector", "'Residential'") not in where
+    assert entry["ApplicationContext"]["Sources"][0]["VisualId"] == commercial.visual_id
+    assert msq.label().startswith("commercial_electrification:")
+    # The default spec keeps the labels (and metrics) the queries always had
+    assert MassSaveQuery(filters=msq.filters).label() == "Year=2019"
+    # The fixed part of the query is built once per spec and shared by its queries
+    assert where[0] is commercial.template["Where"][0]
+    again = MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2020"])], spec=commercial)._create_query()
+    assert again["queries"][0]["ApplicationContext"] is entry["ApplicationContext"]
+
+    with pytest.raises(ValueError, match="Invalid sector"):
+        electrification_spec("Agricultural")
+    other_model = evolve(commercial, model_id=commercial.model_id + 1)
+    with pytest.raises(ValueError, match="model"):
+        MassSaveBatch([msq, MassSaveQuery(filters=msq.filters, spec=other_model)])
+
+
+@define
+class _CountingTokenProvider(StubTokenProvider):
+    fetched: int = field(default=0, kw_only=True)
+
+    async def get_token(self) -> str:
+        self.fetched += 1
+        return await super().get_token()
+
+
+def test_download_many_shares_one_token(powerbi_stub, tmp_path):
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    token_provider = _CountingTokenProvider(token=powerbi_stub.token)
+    jobs = {
+        "residential": DownloadJob(filter_sets=filter_sets, outfile=str(tmp_path / "residential.csv")),
+        # The stub doesn't tell the sectors apart, so both come back with the recorded table
+        "commercial": DownloadJob(
+            filter_sets=filter_sets, spec=electrification_spec("Commercial"), mode="cube", run_dir=tmp_path / "run"
+        ),
+    }
+    tables = download_many(
+        jobs, token_provider=token_provider, cache_mode="bypass", endpoint_url=powerbi_stub.endpoint_url
+    )
+
+    expected = pl.read_csv("tests/artifacts/test_masssave_downloader.csv").cast(pl.Utf8)
+    assert list(tables) == ["residential", "commercial"]
+    assert all(expected.equals(table.cast(pl.Utf8)) for table in tables.values())
+    assert expected.equals(pl.read_csv(tmp_path / "residential.csv").cast(pl.Utf8))
+    assert token_provider.fetched == 1
+
+    with pytest.raises(ValueError, match="run_dir of its own"):
+        download_many({"a": DownloadJob(run_dir=tmp_path / "x"), "b": DownloadJob(run_dir=tmp_path / "x")})
+
+
+def test_masssave_downloader_typed_arrow_output(powerbi_stub, tmp_path):
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    outfile = tmp_path / "masssave.arrows"
+    data = download_masssave_data(
+        outfile=str(outfile),
+        filter_sets=filter_sets,
+        token_provider=powerbi_stub.token_provider(),
+        cache_mode="bypass",
+        endpoint_url=powerbi_stub.endpoint_url,
+        mode="cube",
+        typed=True,
+    )
+
+    assert data.schema == pl.Schema({
+        "year": pl.Int16,
+        "end_use": pl.Enum(["HVAC", "Hot Water"]),
+        "municipality": pl.Categorical(),
+        "installed_hp_accounts": pl.Int32,
+        "installed_hp_locations": pl.Int32,
+    })
+    assert data.schema == masssave_schema(filter_sets)
+    # The same rows in the same order as the untyped table
+    expected = pl.read_csv("tests/artifacts/test_masssave_downloader.csv").cast(pl.Utf8)
+    assert expected.equals(data.cast(pl.Utf8))
+
+    table = to_arrow(data)
+    assert pa.types.is_dictionary(table.schema.field("municipality").type)
+    assert pa.types.is_dictionary(table.schema.field("end_use").type)
+    with pa.ipc.open_stream(outfile) as reader:
+        assert reader.read_all().equals(table)
+    assert pl.read_ipc_stream(outfile).equals(data)
+
+    with pytest.raises(pl.exceptions.InvalidOperationError):
+        apply_schema(data.cast({"end_use": pl.String}), {"Year": ["2019", "2020"], "End use": ["HVAC"]})
+
+
+def test_masssave_downloader_stub_errors_resume(powerbi_stub, tmp_path):
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    options = {
+        "filter_sets": filter_sets,
+        "token_provider": powerbi_stub.token_provider(),
+        "cache_mode": "bypass",
+        "endpoint_url": powerbi_stub.endpoint_url,
+        "run_dir": tmp_path / "run",
+        "retry": RetryPolicy(max_attempts=1),
+    }
+
+    powerbi_stub.error_rate = 0.5
+    with pytest.raises(MassSaveQueryError):
+        download_masssave_data(None, **options)
+    assert powerbi_stub.errors > 0
+
+    powerbi_stub.error_rate = 0.0
+    data = download_masssave_data(None, resume=True, **options)
+    assert data.height == 1030
+
+
+def test_benchmark_smoke():
+    from tests.bench_masssave_downloader import FILTER_SET_SIZES, compare, run_scenario
+
+    results = {f"small/c{c}": run_scenario(FILTER_SET_SIZES["small"], max_concurrency=c) for c in [1, 4]}
+    assert results["small/c4"]["queries"] == 4
+
+    def scaled(c1: float, c4: float) -> dict[str, dict]:
+        qps = {"small/c1": c1, "small/c4": c4}
+        return {name: {"queries_per_s": results[name]["queries_per_s"] * qps[name]} for name in results}
+
+    assert not compare(results, scaled(1, 1), 0.25, same_machine=True)
+    # A faster machine's baseline only counts on that machine; the speedups still match
+    assert compare(results, scaled(2, 2), 0.25, same_machine=True)
+    assert not compare(results, scaled(2, 2), 0.25, same_machine=False)
+    # Losing the speedup of concurrency is a regression anywhere
+    (regression,) = compare(results, scaled(1, 2), 0.25, same_machine=False)
+    assert regression.startswith("small/c4:")
+    assert "small/c1" in regression
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_masssave_downloader_metrics(powerbi_stub, tmp_path, batch_size):
+    recorder = MetricsRecorder()
+    options = {
+        "filter_sets": {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]},
+        "token_provider": powerbi_stub.token_provider(),
+        "cache": ResponseCache(tmp_path / "responses"),
+        "endpoint_url": powerbi_stub.endpoint_url,
+        "batch_size": batch_size,
+        "hooks": [recorder],
+    }
+    download_masssave_data(None, **options)
+
+    df = recorder.frame()
+    assert set(df["query"]) == {f"Year={y}|End use={e}" for y in ["2019", "2020"] for e in ["HVAC", "Hot Water"]}
+    assert (df["status"] == 200).all()
+    assert (df["batch_size"] == batch_size).all()
+    assert (df["response_bytes"] > 0).all()
+    assert df["server_s"].is_not_null().all()
+    assert df["ttfb_s"].is_not_null().all()
+    # One new connection at most per request in flight; the rest reuse them
+    assert df["connect_s"].is_not_null().sum() >= 1
+    assert all(m.server_metrics["Events"][0]["Metrics"]["RowCount"] > 0 for m in recorder.records)
+    assert "4 pages (0 from cache, 0 retries, 0 failed)" in recorder.summary()
+
+    # Answered from the response cache the second time round
+    recorder.records.clear()
+    download_masssave_data(None, **options)
+    assert recorder.frame()["cached"].all()
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(base_delay=1.0, max_delay=10.0)
+    assert policy.delay(0, "3") == 3.0
+    assert policy.delay(0, "120") == 10.0
+    assert policy.delay(0, "Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert all(0 <= policy.delay(attempt) <= min(10.0, 2**attempt) for attempt in range(8) for _ in range(20))
+    assert 0 <= policy.delay(2, "soon") <= 4.0
+
+
+def test_adaptive_rate_limiter():
+    limiter = AdaptiveRateLimiter(rate=10.0, increase=10.0, cooldown=60.0)
+    limiter.on_success()
+    assert limiter.rate == 11.0
+    limiter.on_throttle()
+    limiter.on_throttle()  # still cooling down from the first cut
+    assert limiter.rate == 5.5
+
+    # The first `burst` go straight away, the rest 1/rate apart
+    limiter = AdaptiveRateLimiter(rate=100.0, burst=3)
+    start = time.monotonic()
+    waits = [limiter.acquire() for _ in range(7)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert time.monotonic() - start == pytest.approx(0.04, abs=0.01)
+
+
+def test_masssave_downloader_retries_throttling(powerbi_stub):
+    recorder = MetricsRecorder()
+    limiter = AdaptiveRateLimiter(rate=500.0)
+    powerbi_stub.max_rps = 2
+    powerbi_stub.retry_after = 0.2
+    powerbi_stub.error_rate = 0.2
+    data = download_masssave_data(
+        None,
+        filter_sets={"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]},
+        token_provider=powerbi_stub.token_provider(),
+        cache_mode="bypass",
+        endpoint_url=powerbi_stub.endpoint_url,
+        hooks=[recorder],
+        retry=RetryPolicy(max_attempts=20, base_delay=0.01),
+        rate_limiter=limiter,
+    ).cast(pl.Utf8)
+
+    assert pl.read_csv("tests/artifacts/test_masssave_downloader.csv").cast(pl.Utf8).equals(data)
+    assert powerbi_stub.throttled > 0
+    assert recorder.frame()["retries"].sum() >= powerbi_stub.throttled
+    assert limiter.rate < 500.0
+
+
+def test_masssave_downloader_prune(tmp_path):
+    filter_sets = {"Year": ["2019", "2020"], "Displaced_fuel": ["Gas", "Oil", "Propane"], "End use": ["HVAC"]}
+    table = synthetic_table(filter_sets, n_municipalities=10, empty_combos=0.5)
+    nonempty = table.select("year", "displaced_fuel").unique().height
+    assert 0 < nonempty < 6
+
+    with PowerBIStub(table) as stub:
+        options = {
+            "filter_sets": filter_sets,
+            "token_provider": stub.token_provider(),
+            "cache_mode": "bypass",
+            "endpoint_url": stub.endpoint_url,
+        }
+        everything = download_masssave_data(None, **options)
+        assert stub.queries == 6
+
+        stub.queries = 0
+        pruned = download_masssave_data(None, prune=True, run_dir=tmp_path / "run", **options)
+        # The probe, then only the combinations it found
+        assert stub.queries == 1 + nonempty
+    assert pruned.equals(everything)
+
+    checkpoint = RunCheckpoint(tmp_path / "run")
+    checkpoint.load()
+    assert list(checkpoint.statuses.values()).count("empty") == 6 - nonempty
+
+
+def test_probe_query_leaves_out_the_city():
+    probe = _probe_query({"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]})
+    assert probe.columns() == ["year", "end_use", "installed_hp_accounts", "installed_hp_locations"]
+    query = probe._create_query()["queries"][0]["Query"]["Commands"][0]["SemanticQueryDataShapeCommand"]["Query"]
+    assert [s["Name"] for s in query["Select"]] == [
+        "Dim_Year.Year",
+        "Dim_End_use.End use",
+        "Fact.Participants",
+        "Fact.Participanting locations",
+    ]
+    assert len(query["OrderBy"]) == 2
+
+
+def test_refresh_masssave_snapshot(tmp_path):
+    filter_sets = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"]}
+    table = recorded_table()
+    with PowerBIStub(table) as stub:
+        # Responses go through a cache, which a refresh must not answer from
+        options = {
+            "filter_sets": filter_sets,
+            "token_provider": stub.token_provider(),
+            "cache": ResponseCache(tmp_path / "cache"),
+            "endpoint_url": stub.endpoint_url,
+        }
+        store_dir = tmp_path / "store"
+        first = refresh_masssave_snapshot(store_dir, version="v1", **options)
+        assert stub.queries == 4
+
+        # The service revises one 2020 count; only 2020 is queried again
+        stub.table = table.with_columns(
+            installed_hp_accounts=pl
+            .when((pl.col("year") == "2020") & (pl.col("municipality") == "Acton"))
+            .then(pl.col("installed_hp_accounts") + 1)
+            .otherwise(pl.col("installed_hp_accounts"))
+        )
+        stub.queries = 0
+        second = refresh_masssave_snapshot(store_dir, mutable_years=["2020"], version="v2", **options)
+        assert stub.queries == 2
+
+    store = SnapshotStore(store_dir, key=["year", "end_use", "municipality"])
+    changes = store.changes(first, second)
+    assert changes["municipality"].unique().to_list() == ["Acton"]
+    assert (changes["change"] == "changed").all()
+    assert store.read(first).height == store.read(second).height == 1030
+    objects = {v: {p["values"]["year"]: p["object"] for p in store.manifest(v)["partitions"]} for v in (first, second)}
+    assert objects["v1"]["2019"] == objects["v2"]["2019"]
+    assert objects["v1"]["2020"] != objects["v2"]["2020"]
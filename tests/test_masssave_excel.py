@@ -0,0 +1,120 @@
+import os
+
+import polars as pl
+import pytest
+
+from hp_adoption.masssave.excel import (
+    COLUMNS,
+    MassSaveExcelError,
+    _cache_path,
+    _convert,
+    clean_export,
+    ingest_masssave_excel,
+    parse_export_name,
+)
+
+
+def _raw_sheet(footer: str) -> pl.DataFrame:
+    """A sheet as pl.read_excel returns it: suppressed counts make the columns text."""
+    return pl.DataFrame({
+        "Town": ["Acton", "Boston", "Total", footer],
+        "Accounts": ["12", "*", "40", None],
+        "Locations": ["10", "5", "33", None],
+    })
+
+
+def test_parse_export_name():
+    assert parse_export_name("local_data/hvac_2022_retrofit_nodisplacement.xlsx") == {
+        "year": "2022",
+        "displaced_fuel": "No displacement",
+        "end_use": "HVAC",
+    }
+    assert parse_export_name("hvac_2019_retrofit_oil.xlsx")["displaced_fuel"] == "Oil"
+    with pytest.raises(MassSaveExcelError):
+        parse_export_name("hvac_retrofit.xlsx")
+
+
+def test_clean_export():
+    df = clean_export(
+        _raw_sheet("Applied filters: Year is 2022 and displaced_fuel is No displacement"),
+        "hvac_2022_retrofit_nodisplacement.xlsx",
+    )
+
+    assert df.schema == pl.Schema(COLUMNS)
+    assert df["municipality"].to_list() == ["Acton", "Boston"]
+    assert df["installed_hp_accounts"].to_list() == [12, None]
+    assert df["installed_hp_locations"].to_list() == [10, 5]
+    assert set(df["displaced_fuel"]) == {"No displacement"}
+    assert df["rate_category"].null_count() == 2
+
+
+def test_clean_export_checks_the_footer():
+    with pytest.raises(MassSaveExcelError, match="displaced_fuel is gas"):
+        clean_export(
+            _raw_sheet("Applied filters: Year is 2022 and displaced_fuel is Gas"), "hvac_2022_retrofit_oil.xlsx"
+        )
+
+
+def _write_export(directory, year: str) -> tuple:
+    """An export workbook for `year` and gas, and the rows it should clean to."""
+    path = directory / f"hvac_{year}_retrofit_gas.xlsx"
+    raw = _raw_sheet(f"Applied filters: Year is {year} and displaced_fuel is Gas")
+    raw.write_excel(path)
+    return path, clean_export(raw, path)
+
+
+def test_convert(tmp_path):
+    path, expected = _write_export(tmp_path, "2022")
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    stale = _cache_path(path, cache_dir)
+    stale.write_bytes(b"an older conversion")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    cache_path = _convert(path, _cache_path(path, cache_dir))
+    assert pl.read_parquet(cache_path).equals(expected)
+    assert list(cache_dir.iterdir()) == [cache_path]
+
+
+def test_ingest_converts_exports_in_a_pool(tmp_path):
+    cache_dir = tmp_path / "cache"
+    expected = [_write_export(tmp_path, year)[1] for year in ["2021", "2022", "2023"]]
+
+    result = ingest_masssave_excel(tmp_path, cache_dir=cache_dir, max_workers=2)
+    assert result.equals(pl.concat(expected))
+    assert len(list(cache_dir.glob("*.parquet"))) == 3
+
+    # A workbook that doesn't match its name fails the whole ingest
+    (tmp_path / "hvac_2020_retrofit_oil.xlsx").write_bytes((tmp_path / "hvac_2021_retrofit_gas.xlsx").read_bytes())
+    (tmp_path / "hvac_2019_retrofit_oil.xlsx").write_bytes((tmp_path / "hvac_2021_retrofit_gas.xlsx").read_bytes())
+    with pytest.raises(MassSaveExcelError, match="displaced_fuel is gas"):
+        ingest_masssave_excel(tmp_path, cache_dir=cache_dir, max_workers=2)
+
+
+def test_ingest_reads_cached_exports(tmp_path):
+    """Exports already converted are read from the cache, without opening the workbook."""
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    frames = []
+    for year in ["2021", "2022"]:
+        path = tmp_path / f"hvac_{year}_retrofit_gas.xlsx"
+        path.write_bytes(b"not a workbook")
+        df = clean_export(_raw_sheet(f"Year is {year} and displaced_fuel is Gas"), path)
+        df.write_parquet(_cache_path(path, cache_dir))
+        frames.append(df)
+
+    result = ingest_masssave_excel(tmp_path, cache_dir=cache_dir)
+    assert result.equals(pl.concat(frames))
+
+    # A changed file gets a new cache entry, so it would be converted again
+    path = tmp_path / "hvac_2022_retrofit_gas.xlsx"
+    before = _cache_path(path, cache_dir)
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert _cache_path(path, cache_dir) != before
+
+
+def test_ingest_without_exports(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        ingest_masssave_excel(tmp_path / "*.xlsx", cache_dir=tmp_path / "cache")
@@ -0,0 +1,58 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ["playwright", "requests", "polars"]
+
+# Cumulative import time allowed for the query builder (attrs plus the standard library
+# takes around 0.08 s); a heavy dependency creeping back in costs a multiple of that
+IMPORT_BUDGET_S = 0.25
+
+
+def _loaded_after(code: str) -> set[str]:
+    """Which of HEAVY a fresh interpreter has imported after running `code`."""
+    check = f"import sys\n{code}\nprint(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True).stdout  # noqa: S603
+    return set(out.split())
+
+
+def _import_time(module: str) -> float:
+    """Seconds `python -X importtime` attributes to importing `module`, its dependencies included."""
+    err = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    ).stderr
+    (cumulative,) = re.findall(rf"\|\s*(\d+) \| {re.escape(module)}$", err, flags=re.MULTILINE)
+    return int(cumulative) / 1e6
+
+
+def test_query_builder_imports_no_heavy_dependencies():
+    code = """
+from hp_adoption.masssave import MassSaveFilter, MassSaveQuery, TokenProvider, token_expiry
+MassSaveQuery(filters=[MassSaveFilter(column="Year", values=["2019"])], group_by=["End use"])._create_query()
+"""
+    assert _loaded_after(code) == set()
+
+
+@pytest.mark.parametrize(
+    ("module", "expected"),
+    [
+        ("hp_adoption.masssave.spec", set()),
+        ("hp_adoption.masssave.parse", {"polars"}),
+        ("hp_adoption.masssave.schema", {"polars"}),
+        ("hp_adoption.masssave.transport", {"requests"}),
+        ("hp_adoption.masssave.browser", {"playwright"}),
+        ("hp_adoption.masssave.download", {"requests", "polars"}),
+        ("hp_adoption.masssave.daemon", {"requests", "polars"}),
+        ("hp_adoption.masssave.shards", {"requests", "polars"}),
+    ],
+)
+def test_modules_import_only_their_own_dependencies(module, expected):
+    assert _loaded_after(f"import {module}") == expected
+
+
+def test_query_builder_import_time():
+    # Best of a few runs, so a busy machine doesn't fail the test
+    seconds = min(_import_time("hp_adoption.masssave.query") for _ in range(3))
+    assert seconds < IMPORT_BUDGET_S, f"hp_adoption.masssave.query took {seconds:.3f} s to import"
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+
+import polars as pl
+import pytest
+
+from hp_adoption.masssave import (
+    MassSaveQueryError,
+    WorkManifest,
+    download_masssave_data,
+    merge_shards,
+    run_worker_async,
+)
+from tests.powerbi_stub import PowerBIStub, synthetic_table
+
+FILTER_SETS = {"Year": ["2019", "2020"], "End use": ["HVAC", "Hot Water"], "Rate_category": ["Market rate"]}
+
+
+def test_shard_workers_merge_to_the_full_table(tmp_path):
+    manifest = WorkManifest.create(tmp_path / "run", FILTER_SETS, shard_by=["Year", "End use"], mode="cube")
+    assert manifest.shards == {
+        "0": {"Year": "2019", "End use": "HVAC"},
+        "1": {"Year": "2019", "End use": "Hot Water"},
+        "2": {"Year": "2020", "End use": "HVAC"},
+        "3": {"Year": "2020", "End use": "Hot Water"},
+    }
+    assert manifest.shard_job("2").filter_sets == {
+        "Year": ["2020"],
+        "End use": ["HVAC"],
+        "Rate_category": ["Market rate"],
+    }
+    with pytest.raises(MassSaveQueryError, match="4 of 4 shards"):
+        merge_shards(manifest.path)
+
+    # One town in five is left out of a combination, so the shards come back ragged
+    with PowerBIStub(synthetic_table(FILTER_SETS, n_municipalities=40, empty_combos=0.25, seed=3)) as stub:
+        options = {
+            "token_provider": stub.token_provider(),
+            "cache_mode": "bypass",
+            "endpoint_url": stub.endpoint_url,
+            "report": False,
+        }
+
+        async def workers():
+            return await asyncio.gather(*(run_worker_async(manifest.path, worker=f"w{i}", **options) for i in range(3)))
+
+        results = asyncio.run(workers())
+        expected = download_masssave_data(None, FILTER_SETS, **options)
+
+    assert sorted(shard for result in results for shard in result["done"]) == ["0", "1", "2", "3"]
+    assert manifest.status() == dict.fromkeys(manifest.shards, "done")
+    assert not list((manifest.path / "leases").iterdir())
+    assert not (manifest.path / "runs").exists() or not list((manifest.path / "runs").iterdir())
+
+    assert expected.equals(merge_shards(manifest.path, outfile=str(tmp_path / "merged.csv")))
+    assert pl.read_csv(tmp_path / "merged.csv", schema=expected.schema).equals(expected)
+
+
+def test_typed_shards_merge_to_the_typed_table(tmp_path):
+    """Each shard pins one value of the shard_by dimensions, yet the merge has the Enums of the whole product."""
+    manifest = WorkManifest.create(tmp_path / "run", FILTER_SETS, shard_by=["Year", "End use"], mode="cube", typed=True)
+    with PowerBIStub(synthetic_table(FILTER_SETS, n_municipalities=10, seed=3)) as stub:
+        options = {
+            "token_provider": stub.token_provider(),
+            "cache_mode": "bypass",
+            "endpoint_url": stub.endpoint_url,
+            "report": False,
+        }
+        asyncio.run(run_worker_async(manifest.path, **options))
+        expected = download_masssave_data(None, FILTER_SETS, mode="cube", typed=True, **options)
+
+    merged = merge_shards(manifest.path, outfile=str(tmp_path / "merged.arrow"))
+    assert merged.schema["end_use"] == pl.Enum(["HVAC", "Hot Water"])
+    assert merged.equals(expected)
+    assert pl.read_ipc_stream(tmp_path / "merged.arrow").equals(expected)
+
+
+def test_shard_leases(tmp_path):
+    manifest = WorkManifest.create(tmp_path / "run", FILTER_SETS)
+    with pytest.raises(FileExistsError):
+        WorkManifest.create(tmp_path / "run", FILTER_SETS)
+    with pytest.raises(ValueError, match="Shards don't take"):
+        WorkManifest.create(tmp_path / "other", FILTER_SETS, outfile="x.csv")
+
+    assert manifest.claim("a") == "0"
+    assert manifest.claim("b") == "1"
+    assert manifest.claim("c") is None
+    assert manifest.holder("0")["worker"] == "a"
+    assert not manifest.renew("0", "b")
+
+    # a stops renewing: once its lease has run out, the shard goes to someone else
+    lease = manifest.path / "leases" / "0.lease"
+    lease.write_text(json.dumps({"worker": "a", "expires": time.time() - 1}))
+    assert manifest.status() == {"0": "expired", "1": "leased"}
+    assert manifest.claim("c") == "0"
+    assert manifest.holder("0")["worker"] == "c"
+    assert not manifest.renew("0", "a")
+    assert manifest.renew("0", "c")
+
+    manifest.release("1", "c")  # not its lease
+    assert manifest.holder("1")["worker"] == "b"
+    manifest.release("1", "b")
+    assert manifest.claim("d") == "1"
+    assert sorted(p.name for p in lease.parent.iterdir()) == ["0.lease", "1.lease"]
@@ -0,0 +1,63 @@
+import polars as pl
+import pytest
+
+from hp_adoption.rollups import DIMENSIONS, MEASURES, RollupCube
+from hp_adoption.snapshots import SnapshotStore
+from tests.powerbi_stub import synthetic_table
+
+
+def _direct(df: pl.DataFrame, by: list[str]) -> pl.DataFrame:
+    return df.group_by(by).agg(pl.col(MEASURES).sum()).sort(by, nulls_last=True)
+
+
+def test_rollup_cube_queries(tmp_path):
+    df = synthetic_table(n_municipalities=20, empty_combos=0.3)
+    cube = RollupCube(tmp_path)
+    cube.build(df, "v1")
+
+    assert len(cube.state()["rollups"]) == 2 ** len(DIMENSIONS)
+    assert cube.version == "v1"
+    # Grouping by year and fuel never needs the municipality-level rows
+    assert cube.covering_rollup({"year", "displaced_fuel"}) == ("year", "displaced_fuel")
+    assert cube.covering_rollup(set()) == ()
+
+    by = ["year", "displaced_fuel"]
+    assert cube.query(by).equals(_direct(df, by))
+    assert cube.query().equals(df.select(pl.col(MEASURES).sum()))
+
+    acton = cube.query(["year"], where={"municipality": [df["municipality"][0]]})
+    assert acton.equals(_direct(df.filter(pl.col("municipality") == df["municipality"][0]), ["year"]))
+
+    with pytest.raises(ValueError, match="town"):
+        cube.query(["town"])
+
+
+def test_rollup_cube_updates_incrementally(tmp_path):
+    store = SnapshotStore(tmp_path / "snapshots", key=DIMENSIONS)
+    first = synthetic_table(n_municipalities=10, seed=1)
+    store.commit(first, "v1")
+    cube = RollupCube(tmp_path / "rollups")
+    cube.update(store)
+
+    # One count revised, one row gone and a new municipality in the last year
+    last_year = first["year"].max()
+    new_rows = first.filter(pl.col("year") == last_year).head(3).with_columns(municipality=pl.lit("Newtown"))
+    second = pl.concat([
+        first.slice(1).with_columns(
+            installed_hp_locations=pl
+            .when(pl.int_range(pl.len()) == 5)
+            .then(pl.col("installed_hp_locations") + 7)
+            .otherwise(pl.col("installed_hp_locations"))
+        ),
+        new_rows,
+    ])
+    store.commit(second, "v2")
+    cube.update(store)
+
+    assert cube.version == "v2"
+    rebuilt = RollupCube(tmp_path / "rebuilt")
+    rebuilt.build(store.read("v2"), "v2")
+    for by in [[], ["year"], ["municipality"], ["year", "displaced_fuel", "rate_category"], DIMENSIONS]:
+        assert cube.query(by).equals(rebuilt.query(by)), by
+    # Only the rollups of the current version are kept
+    assert sorted(p.name for p in (tmp_path / "rollups").iterdir()) == ["cube.json", "rollups-v2"]
@@ -0,0 +1,60 @@
+import polars as pl
+import pytest
+
+from hp_adoption.snapshots import SnapshotStore, diff_frames
+
+
+def _objects(store: SnapshotStore) -> int:
+    return len(list(store.objects_dir.rglob("*.parquet")))
+
+
+def test_snapshot_store_shares_unchanged_partitions(tmp_path):
+    store = SnapshotStore(tmp_path, key=["year", "town"])
+    first = pl.DataFrame({"year": ["2019", "2019", "2020"], "town": ["a", "b", "a"], "n": [1, 2, 3]})
+    second = pl.DataFrame({"year": ["2019", "2019", "2020", "2020"], "town": ["b", "a", "a", "c"], "n": [2, 1, 4, 5]})
+
+    store.commit(first, "v1")
+    assert _objects(store) == 3  # two partitions and the schema
+    store.commit(second, "v2")
+    # 2019 is the same rows in a different order, so only the new 2020 partition is written
+    assert _objects(store) == 4
+
+    assert store.versions() == ["v1", "v2"]
+    assert store.latest() == "v2"
+    assert store.manifest("v2")["parent"] == "v1"
+    assert store.read("v1").equals(first.sort("year", "town"))
+    assert store.read().equals(second.sort("year", "town"))
+    assert store.read("v2", where={"year": ["2020"]})["town"].to_list() == ["a", "c"]
+
+    with pytest.raises(FileExistsError):
+        store.commit(first, "v1")
+    with pytest.raises(KeyError):
+        store.read("v3")
+
+
+def test_snapshot_store_changes(tmp_path):
+    store = SnapshotStore(tmp_path, key=["year", "town"])
+    store.commit(pl.DataFrame({"year": ["2019", "2020", "2020"], "town": ["a", "a", "b"], "n": [1, 3, 6]}), "v1")
+    store.commit(pl.DataFrame({"year": ["2019", "2020", "2020"], "town": ["a", "a", "c"], "n": [1, 4, 5]}), "v2")
+
+    changes = store.changes("v1", "v2")
+    assert changes.rows() == [
+        ("2020", "a", "changed", 3, 4),
+        ("2020", "b", "removed", 6, None),
+        ("2020", "c", "added", None, 5),
+    ]
+    assert changes.columns == ["year", "town", "change", "n_old", "n_new"]
+    assert store.changes("v2", "v2").is_empty()
+    assert store.changes(None, "v1")["change"].to_list() == ["added"] * 3
+
+
+def test_snapshot_store_empty_version(tmp_path):
+    store = SnapshotStore(tmp_path, key=["year", "town"])
+    store.commit(pl.DataFrame(schema={"year": pl.String, "town": pl.String, "n": pl.Int64}), "empty")
+    assert store.read("empty").schema == pl.Schema({"year": pl.String, "town": pl.String, "n": pl.Int64})
+
+
+def test_diff_frames_treats_nulls_as_values():
+    old = pl.DataFrame({"k": ["a", "b"], "v": [None, 1]})
+    new = pl.DataFrame({"k": ["a", "b"], "v": [None, None]})
+    assert diff_frames(old, new, ["k"]).rows() == [("b", "changed", 1, None)]